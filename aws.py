@@ -13,21 +13,90 @@ if os.environ.get("AWS_PROFILE"):
 
 Session = boto3.Session(**options)
 
-from summarize import mbta_feed_url_for, process_file, CURRENT_FEED_URL
+from summarize import aggregates_path, mbta_feed_url_for, metrics_path, \
+    process_file, profile_path, profiled, route_aggregates, write_summary, \
+    StageMetrics, CURRENT_FEED_URL, WRITE_METRICS
+
+# Summarize each file in at least this many pieces to limit memory use
+PARTITIONS = int(os.environ.get("MBTA_SUMMARIZE_PARTITIONS", 0)) or None
+# Either "csv" or "parquet"
+SUMMARY_FORMAT = os.environ.get("MBTA_SUMMARY_FORMAT", "csv")
+
+if SUMMARY_FORMAT == "parquet":
+    # Fail when the function loads, rather than after summarizing each file
+    try:
+        import pyarrow
+    except ImportError:
+        try:
+            import fastparquet
+        except ImportError:
+            raise ImportError("MBTA_SUMMARY_FORMAT=parquet requires pyarrow "
+                              "(see requirements.txt)")
 
 
 def do_summarize(bucket, key):
     S3 = Session.client("s3")
 
-    filename = key[0:-3]
+    # Summaries of observation files go where those of the CSV files would
+    filename = re.sub(r"\.obs\.gz$", ".csv.gz", key)[0:-3]
+    if SUMMARY_FORMAT == "parquet":
+        summary_key = f"summary/{filename[0:-4]}.parquet"
+    else:
+        summary_key = f"summary/{filename}.csv.gz"
+    # Each stage is logged as it ends, so the log of a run that timed out
+    # shows the stage it was in
+    metrics = StageMetrics(key)
+    profile = profile_path(filename)
+    try:
+        with profiled(profile), tempfile.TemporaryDirectory() as download_dir:
+            # Observation files can only be read locally, and the size of a
+            # local file decides how many partitions to summarize it in
+            source = os.path.join(download_dir, os.path.basename(key))
+            with metrics.stage("download"):
+                S3.download_file(bucket, key, source)
+            summarize_to_s3(S3, bucket, source, summary_key, metrics)
+    finally:
+        metrics.log()
+        if WRITE_METRICS:
+            local_file = os.path.join(tempfile.gettempdir(), "metrics.json")
+            metrics.write(local_file)
+            S3.upload_file(local_file, bucket, metrics_path(summary_key))
+            os.remove(local_file)
+        if profile and os.path.exists(profile):
+            S3.upload_file(profile, bucket,
+                           f"profiles/{os.path.basename(profile)}")
+            os.remove(profile)
+
 
-    with tempfile.NamedTemporaryFile('w', suffix=".csv.gz", delete=False) as f:
-        print(f"Writing to {f.name}")
-        local_file = f.name
-        df = process_file(f"s3://{bucket}/{key}")
-        df.to_csv(f)
+def summarize_to_s3(S3, bucket, source, summary_key, metrics):
+    if SUMMARY_FORMAT == "parquet":
+        with tempfile.NamedTemporaryFile(suffix=".parquet", delete=False) as f:
+            local_file = f.name
+        print(f"Writing to {local_file}")
+        df = process_file(source, partitions=PARTITIONS, metrics=metrics)
+        with metrics.stage("write_summary") as info:
+            write_summary(df, local_file)
+            info["rows"] = len(df)
+    else:
+        with tempfile.NamedTemporaryFile('w', suffix=".csv.gz", delete=False) as f:
+            print(f"Writing to {f.name}")
+            local_file = f.name
+            df = process_file(source, partitions=PARTITIONS, metrics=metrics)
+            with metrics.stage("write_summary") as info:
+                df.to_csv(f)
+                info["rows"] = len(df)
+
+    with metrics.stage("upload_summary"):
+        S3.upload_file(local_file, bucket, summary_key)
+    os.remove(local_file)
 
-    S3.upload_file(local_file, bucket, f"summary/{filename}.csv.gz")
+    with metrics.stage("route_aggregates") as info:
+        with tempfile.NamedTemporaryFile('w', suffix=".csv", delete=False) as f:
+            local_file = f.name
+            aggregates = route_aggregates(df)
+            aggregates.to_csv(f, index=False)
+            info["rows"] = len(aggregates)
+        S3.upload_file(local_file, bucket, aggregates_path(summary_key))
     os.remove(local_file)
 
 
@@ -38,7 +107,7 @@ def summarize(event, context):
         return
 
     key = record["object"]["key"]
-    m = re.match(r"\d{4}/\d{2}/\d{4}-\d{2}-\d{2}\.csv\.gz$", key)
+    m = re.match(r"\d{4}/\d{2}/\d{4}-\d{2}-\d{2}\.(csv|obs)\.gz$", key)
     if not m:
         return
 
@@ -0,0 +1,467 @@
+# Benchmarks the summarize pipeline offline, on synthetic GTFS feeds and
+# daily observation files.
+#
+# The fixtures are generated at the requested scale (trips per service day,
+# stops per trip and days of observations) and kept in the fixtures
+# directory for later runs. The feed has weekday, Saturday and Sunday
+# service, so most of its trips are not observed on any given day, as with
+# the real feeds. Each day's file has one to three observations at about
+# 70% of its trips' stops, with a drifting delay, and about 10% of trips
+# are missing from the schedule.
+#
+# Each stage of process_file (and of the route summaries over the whole
+# run) is timed, and the process's peak RSS is taken after it. Results are
+# written as JSON, by default to benchmarks/<commit>.json, and can be
+# compared with an earlier run:
+#   python benchmark.py --trips 5000 --stops 30 --days 3
+#   python benchmark.py --compare benchmarks/0446549.json
+#   python benchmark.py --diff benchmarks/0446549.json benchmarks/8ad8c16.json
+
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import observations
+import route_summaries
+import summarize
+
+
+BENCHMARK_DIR = "benchmarks"
+
+STATUSES = np.array(["IN_TRANSIT_TO", "INCOMING_AT", "STOPPED_AT"])
+# The service of each day of the week, Monday first
+SERVICES = ["weekday"] * 5 + ["saturday", "sunday"]
+TRIPS_PER_ROUTE = 60
+# The share of scheduled stops with observations
+OBSERVED_STOPS = 0.7
+# The share of trips whose trip_id is not in the feed
+UNSCHEDULED_TRIPS = 0.1
+
+# A stage is a regression if it is this many times slower than before, and
+# at least MIN_REGRESSION_SECONDS slower
+REGRESSION_RATIO = 1.2
+MIN_REGRESSION_SECONDS = 0.01
+
+
+def format_clock_times(seconds):
+    return [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}"
+            for s in seconds.tolist()]
+
+
+def schedule(trips, stops, seed=0):
+    """Returns the arrival time at each stop of each trip of one service, in
+    seconds after the start of the service day, as an array of shape
+    (trips, stops)."""
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(5 * 3600, 25 * 3600 + 1800, trips)
+    hops = rng.integers(60, 180, (trips, stops))
+    hops[:, 0] = 0
+    return starts[:, np.newaxis] + hops.cumsum(axis=1)
+
+
+def trip_ids(service, trips):
+    return np.array([f"{service}-{i}" for i in range(trips)], dtype=object)
+
+
+def write_feed(path, trips, stops, seed=0):
+    """Writes a GTFS archive to `path` with `trips` trips of `stops` stops
+    for each of weekday, Saturday and Sunday service."""
+    routes = max(1, trips // TRIPS_PER_ROUTE)
+    route_ids = [str(i + 1) for i in range(routes)]
+    stop_ids = [str(70000 + i) for i in range(routes * stops)]
+    trip_frames = []
+    stop_time_frames = []
+    for service in sorted(set(SERVICES)):
+        ids = trip_ids(service, trips)
+        routes_of_trips = np.arange(trips) % routes
+        trip_frames.append(pd.DataFrame({
+            "route_id": np.array(route_ids)[routes_of_trips],
+            "service_id": service,
+            "trip_id": ids,
+            "trip_headsign": "Synthetic",
+            "direction_id": np.arange(trips) // routes % 2,
+        }))
+        arrivals = format_clock_times(
+            schedule(trips, stops, seed + len(stop_time_frames)).ravel())
+        stop_time_frames.append(pd.DataFrame({
+            "trip_id": np.repeat(ids, stops),
+            "arrival_time": arrivals,
+            "departure_time": arrivals,
+            "stop_id": np.array(stop_ids)[
+                np.repeat(routes_of_trips * stops, stops) +
+                np.tile(np.arange(stops), trips)],
+            "stop_sequence": np.tile(np.arange(1, stops + 1), trips),
+        }))
+
+    tables = {
+        "agency": pd.DataFrame({"agency_id": ["1"], "agency_name": ["MBTA"],
+                                "agency_url": ["http://www.mbta.com"],
+                                "agency_timezone": ["America/New_York"]}),
+        "calendar": pd.DataFrame([
+            [service] + [int(SERVICES[d] == service) for d in range(7)] +
+            ["20000101", "20991231"] for service in sorted(set(SERVICES))],
+            columns=["service_id", "monday", "tuesday", "wednesday",
+                     "thursday", "friday", "saturday", "sunday",
+                     "start_date", "end_date"]),
+        "routes": pd.DataFrame({"route_id": route_ids,
+                                "route_short_name": route_ids,
+                                "route_type": 3}),
+        "stops": pd.DataFrame({"stop_id": stop_ids,
+                               "stop_name": stop_ids,
+                               "stop_lat": 42.35,
+                               "stop_lon": -71.06}),
+        "trips": pd.concat(trip_frames, ignore_index=True),
+        "stop_times": pd.concat(stop_time_frames, ignore_index=True),
+    }
+    tmp_path = path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as feed:
+        for name, df in tables.items():
+            feed.writestr(name + ".txt", df.to_csv(index=False))
+    os.replace(tmp_path, path)
+
+
+def write_day(path, day, trips, stops, seed=0):
+    """Writes a daily file of observations to `path` for the service on
+    `day`, in the recorder's CSV format, in time order."""
+    service = SERVICES[day.weekday()]
+    offset = sorted(set(SERVICES)).index(service)
+    arrivals = schedule(trips, stops, seed + offset)
+    rng = np.random.default_rng([seed, day.toordinal()])
+
+    # Each trip starts late or early and drifts from stop to stop
+    delays = rng.normal(60, 120, (trips, 1)) + \
+        rng.normal(0, 30, (trips, stops)).cumsum(axis=1)
+    observed = rng.random((trips, stops)) < OBSERVED_STOPS
+    counts = np.where(observed, rng.integers(1, 4, (trips, stops)), 0).ravel()
+    trip_index = np.repeat(np.arange(trips), stops)[counts > 0]
+    stop_index = np.tile(np.arange(stops), trips)[counts > 0]
+    counts = counts[counts > 0]
+    # The position of each report among its stop's reports
+    repeats = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts,
+                                                  counts)
+    trip_index = np.repeat(trip_index, counts)
+    stop_index = np.repeat(stop_index, counts)
+
+    start = summarize.get_date(day.strftime("%Y-%m-%d"))
+    seconds = arrivals[trip_index, stop_index] + \
+        delays[trip_index, stop_index].astype(np.int64) + repeats * 15
+    timestamps = pd.Timestamp(start).tz_convert("UTC").tz_localize(None) + \
+        pd.to_timedelta(seconds, unit="s")
+
+    ids = trip_ids(service, trips)
+    unscheduled = rng.random(trips) < UNSCHEDULED_TRIPS
+    ids[unscheduled] = [f"ADDED-{i}" for i in np.flatnonzero(unscheduled)]
+    routes = max(1, trips // TRIPS_PER_ROUTE)
+    df = pd.DataFrame({
+        "trip_id": ids[trip_index],
+        "trip_start": day.strftime("%Y-%m-%d"),
+        "stop_id": (70000 + trip_index % routes * stops + stop_index)
+                   .astype(str),
+        "stop_sequence": stop_index + 1,
+        "vehicle_id": np.char.add("y", (1000 + trip_index % 900).astype(str)),
+        "status": STATUSES[rng.integers(0, len(STATUSES), len(trip_index))],
+        "timestamp": timestamps,
+        "lat": np.round(42.35 + rng.normal(0, 0.05, len(trip_index)), 6),
+        "lon": np.round(-71.06 + rng.normal(0, 0.05, len(trip_index)), 6),
+    }, columns=summarize.RAW_COLUMNS)
+    df = df.sort_values("timestamp", kind="mergesort")
+    df["timestamp"] = df["timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    tmp_path = path + ".tmp"
+    df.to_csv(tmp_path, index=False, compression="gzip")
+    os.replace(tmp_path, path)
+
+
+def make_fixtures(fixture_dir, trips, stops, days, start, seed=0,
+                  fmt="csv"):
+    """Generates the fixtures for the given scale under `fixture_dir`,
+    unless they are already there. Returns the path of the feed and the
+    paths of the daily files, which are observation files (see
+    observations.py) if `fmt` is "obs"."""
+    directory = os.path.join(fixture_dir,
+                             f"{trips}-trips-{stops}-stops-seed-{seed}")
+    os.makedirs(directory, exist_ok=True)
+    feed_path = os.path.join(directory, "feed.zip")
+    if not os.path.exists(feed_path):
+        print(f"Generating {feed_path}")
+        write_feed(feed_path, trips, stops, seed)
+
+    paths = []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        path = os.path.join(directory, summarize.filepath_from_date(day))
+        if not os.path.exists(path):
+            print(f"Generating {path}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_day(path, day, trips, stops, seed)
+        if fmt == "obs":
+            obs_path = path[:-len(".csv.gz")] + observations.SUFFIX
+            if not os.path.exists(obs_path):
+                observations.convert_csv(path, obs_path)
+            path = obs_path
+        paths.append(path)
+    return feed_path, paths
+
+
+def max_rss_mb():
+    return summarize.max_rss_bytes() / 2**20
+
+
+@contextmanager
+def timed(timings, stage):
+    """Times the block, adding its wall time, the rows it produced (set
+    "rows" in the yielded dict) and the peak RSS of the process after it to
+    timings[stage]."""
+    info = {}
+    rss_before = max_rss_mb()
+    started = time.perf_counter()
+    yield info
+    seconds = time.perf_counter() - started
+    rss = max_rss_mb()
+    timings[stage].append({"seconds": seconds,
+                           "rows": info.get("rows"),
+                           "max_rss_mb": rss,
+                           "rss_growth_mb": rss - rss_before})
+
+
+def time_day(timings, filepath, feed_path, outdir, cache_dir,
+             partitions=None):
+    """Runs the stages of process_file on `filepath`, then writes its
+    summary and route aggregates to `outdir`. The feed's tables are first
+    parsed into the empty `cache_dir`, then read back from it."""
+    dt = summarize.date_from_filepath(filepath)
+    trip_start = summarize.get_date(dt.strftime("%Y-%m-%d"))
+
+    with timed(timings, "open_feed"):
+        feed = zipfile.ZipFile(feed_path)
+    for stage in ["feed_tables_parse", "feed_tables_cached"]:
+        if stage == "feed_tables_parse":
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        summarize._feed_tables.clear()
+        with timed(timings, stage) as info:
+            info["rows"] = sum(len(summarize.get_feed_table(feed, name))
+                               for name in summarize.FEED_TABLES)
+            summarize.get_trip_offsets(feed)
+
+    if partitions:
+        with timed(timings, "process_file_streaming") as info:
+            summary = summarize.process_file_streaming(
+                filepath, feed, trip_start, partitions)
+            info["rows"] = len(summary)
+    else:
+        with timed(timings, "get_df") as info:
+            df = summarize.get_df(filepath)
+            info["rows"] = len(df)
+        with timed(timings, "add_schedule_times") as info:
+            stops = summarize.add_schedule_times(df, feed)
+            info["rows"] = len(stops)
+        del df
+        with timed(timings, "summarize_trips") as info:
+            summary = summarize.summarize_trips(stops, trip_start)
+            info["rows"] = len(summary)
+        del stops
+    with timed(timings, "add_route_info") as info:
+        summary = summarize.add_route_info(summary, feed)
+        info["rows"] = len(summary)
+
+    outpath = os.path.join(outdir, dt.strftime("%Y-%m-%d") + ".csv")
+    with timed(timings, "write_summary"):
+        summarize.write_summary(summary, outpath)
+    with timed(timings, "route_aggregates") as info:
+        aggregates = summarize.route_aggregates(summary)
+        aggregates.to_csv(summarize.aggregates_path(outpath), index=False)
+        info["rows"] = len(aggregates)
+    feed.close()
+    return outpath
+
+
+def time_routes(timings, summary_paths):
+    """Times the route summaries of the trip summaries at `summary_paths`."""
+    with timed(timings, "route_summaries_rush_hour") as info:
+        info["rows"] = len(route_summaries.summarize_route_files(
+            summary_paths, route_summaries.rush_hour_filter, processes=1))
+    with timed(timings, "route_summaries_windows") as info:
+        info["rows"] = len(route_summaries.summarize_route_files(
+            summary_paths, processes=1,
+            windows=route_summaries.RUSH_HOUR_WINDOWS))
+    with timed(timings, "route_summaries_aggregates") as info:
+        info["rows"] = len(route_summaries.summarize_route_aggregates(
+            [summarize.aggregates_path(path) for path in summary_paths]))
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip()
+
+
+def run(trips=2000, stops=25, days=3, start=datetime(2018, 11, 12),
+        repeat=3, seed=0, fmt="csv", partitions=None,
+        fixture_dir=os.path.join(BENCHMARK_DIR, "fixtures")):
+    """Runs the benchmark and returns its results, a JSON-serializable
+    dict. Each day is processed `repeat` times, and each stage's best time
+    is its "min" (the one to compare)."""
+    feed_path, paths = make_fixtures(fixture_dir, trips, stops, days, start,
+                                     seed, fmt)
+    timings = defaultdict(list)
+    saved_cache_dir = summarize.FEED_CACHE_DIR
+    with tempfile.TemporaryDirectory(prefix="benchmark") as tmpdir:
+        summarize.FEED_CACHE_DIR = os.path.join(tmpdir, "feed_cache")
+        outdir = os.path.join(tmpdir, "summary")
+        os.makedirs(outdir)
+        try:
+            for _ in range(repeat):
+                summary_paths = [
+                    time_day(timings, path, feed_path, outdir,
+                             summarize.FEED_CACHE_DIR, partitions)
+                    for path in paths]
+                time_routes(timings, summary_paths)
+        finally:
+            summarize.FEED_CACHE_DIR = saved_cache_dir
+            summarize._feed_tables.clear()
+
+    stages = {}
+    for stage, runs in timings.items():
+        # Days are timed separately, but compared as a total
+        per_repeat = len(runs) // repeat
+        totals = [sum(run["seconds"] for run in runs[i:i+per_repeat])
+                  for i in range(0, len(runs), per_repeat)]
+        stages[stage] = {
+            "seconds": totals,
+            "min": min(totals),
+            "median": statistics.median(totals),
+            "rows": None if runs[0]["rows"] is None else
+                    sum(run["rows"] for run in runs[:per_repeat]),
+            "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+            "rss_growth_mb": max(run["rss_growth_mb"] for run in runs),
+        }
+    return {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "params": {"trips": trips, "stops": stops, "days": days,
+                   "start": start.strftime("%Y-%m-%d"), "repeat": repeat,
+                   "seed": seed, "format": fmt, "partitions": partitions},
+        "stages": stages,
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def print_results(results):
+    print(f"{'stage':30} {'min s':>9} {'median s':>9} {'rows':>9} "
+          f"{'peak MB':>8}")
+    for stage, result in results["stages"].items():
+        rows = "" if result["rows"] is None else result["rows"]
+        print(f"{stage:30} {result['min']:9.3f} {result['median']:9.3f} "
+              f"{rows:>9} {result['max_rss_mb']:8.0f}")
+
+
+def compare(old, new, ratio=REGRESSION_RATIO):
+    """Prints the best time of each stage in the results `new` relative to
+    `old`. Returns the stages that got slower by more than `ratio`."""
+    if old["params"] != new["params"]:
+        print(f"Warning: the parameters differ ({old['params']} and "
+              f"{new['params']})")
+    print(f"{'stage':30} {old['commit'] or 'old':>9} {new['commit'] or 'new':>9}"
+          f" {'ratio':>7}")
+    regressions = []
+    stages = list(new["stages"]) + [stage for stage in old["stages"]
+                                    if stage not in new["stages"]]
+    for stage in stages:
+        if stage not in old["stages"] or stage not in new["stages"]:
+            print(f"{stage:30} only in the "
+                  f"{'new' if stage in new['stages'] else 'old'} results")
+            continue
+        before = old["stages"][stage]["min"]
+        after = new["stages"][stage]["min"]
+        change = after / before if before else float("inf")
+        slower = change > ratio and after - before >= MIN_REGRESSION_SECONDS
+        if slower:
+            regressions.append(stage)
+        print(f"{stage:30} {before:9.3f} {after:9.3f} {change:6.2f}x"
+              f"{'  SLOWER' if slower else ''}")
+    print(f"{'peak RSS (MB)':30} {old['max_rss_mb']:9.0f} "
+          f"{new['max_rss_mb']:9.0f} "
+          f"{new['max_rss_mb'] / old['max_rss_mb']:6.2f}x")
+    return regressions
+
+
+def load_results(path):
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the summarize pipeline on synthetic data")
+    parser.add_argument("--trips", type=int, default=2000,
+                        help="trips per service day")
+    parser.add_argument("--stops", type=int, default=25,
+                        help="stops per trip")
+    parser.add_argument("--days", type=int, default=3,
+                        help="days of observations")
+    parser.add_argument("--start", default="2018-11-12",
+                        type=lambda d: datetime.strptime(d, "%Y-%m-%d"),
+                        help="the first day, as YYYY-mm-dd")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["csv", "obs"], default="csv",
+                        help="format of the daily files")
+    parser.add_argument("--partitions", type=int,
+                        help="summarize each file with process_file_streaming")
+    parser.add_argument("--fixtures",
+                        default=os.path.join(BENCHMARK_DIR, "fixtures"),
+                        help="where to keep the generated feed and files")
+    parser.add_argument("-o", "--output",
+                        help="where to write the results (by default, "
+                        f"{BENCHMARK_DIR}/<commit>.json)")
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help="compare with earlier results, failing if a "
+                        "stage got slower")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved results, without running")
+    parser.add_argument("--ratio", type=float, default=REGRESSION_RATIO,
+                        help="slowdown that counts as a regression")
+    args = parser.parse_args(args)
+
+    if args.diff:
+        old, new = map(load_results, args.diff)
+    else:
+        new = run(args.trips, args.stops, args.days, args.start, args.repeat,
+                  args.seed, args.format, args.partitions, args.fixtures)
+        print_results(new)
+        output = args.output or os.path.join(
+            BENCHMARK_DIR, f"{new['commit'] or 'results'}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as outfile:
+            json.dump(new, outfile, indent=2)
+        print(f"Wrote {output}")
+        if not args.compare:
+            return
+        old = load_results(args.compare)
+
+    if compare(old, new, args.ratio):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,21 @@ fi
 updates_dir="${MBTA_UPDATES_DIR:-$default_dir}"
 
 cd "$updates_dir"
-uniq < $trip_start.csv > ${trip_start}_unique.csv
-gzip ${trip_start}_unique.csv
 export AWS_PROFILE=db_dump
-aws s3 cp ${trip_start}_unique.csv.gz \
-    s3://mbta-history.apptic.xyz/$keydir/$trip_start.csv.gz \
-    --acl public-read || exit 1
-rm $trip_start.csv
+if [ -f $trip_start.obs ]; then
+    # Written by record.py with MBTA_RECORD_FORMAT=obs
+    gzip < $trip_start.obs > $trip_start.obs.gz
+    aws s3 cp $trip_start.obs.gz \
+        s3://mbta-history.apptic.xyz/$keydir/$trip_start.obs.gz \
+        --acl public-read || exit 1
+    rm $trip_start.obs $trip_start.obs.gz
+else
+    # record.py only writes each vehicle report once, so no uniq pass is
+    # needed
+    gzip < $trip_start.csv > ${trip_start}_unique.csv.gz
+    aws s3 cp ${trip_start}_unique.csv.gz \
+        s3://mbta-history.apptic.xyz/$keydir/$trip_start.csv.gz \
+        --acl public-read || exit 1
+    rm $trip_start.csv
+fi
 cd -
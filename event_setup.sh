@@ -38,6 +38,21 @@ aws s3api put-bucket-notification-configuration \
         ]
       }
     }
+    },
+    {
+      "Id": "summarize-observations-on-upload",
+      "LambdaFunctionArn": "'$lambda_arn'",
+      "Events": ["s3:ObjectCreated:*"],
+      "Filter": {
+        "Key": {
+        "FilterRules": [
+          {
+             "Name": "suffix",
+             "Value": ".obs.gz"
+          }
+        ]
+      }
+    }
     }
   ]
 }
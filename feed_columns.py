@@ -0,0 +1,299 @@
+# Fast extraction of vehicle positions from a serialized FeedMessage into
+# columns (one list per field of record.UPDATE_FIELDS) instead of a dict
+# per vehicle.
+#
+# With the pure-Python protobuf implementation, which the generated
+# gtfs_realtime_pb2 module needs with protobuf 4 and later, parsing builds
+# an object for every nested message. This module instead reads the few
+# fields it needs straight from the wire format, in one pass, and skips
+# everything else. With the C++ or upb implementation, parsing is cheap,
+# so the message is parsed and its fields read into columns. Either way,
+# enum names and formatted dates are looked up once and cached. The
+# recorder and replay.py read vehicle positions this way (see
+# record.parse_vehicle_positions).
+#
+# To compare with parsing and make_update_dict on recorded feeds (snapshot
+# archives or .pb files), or on a synthetic feed:
+#   python feed_columns.py updates/snapshots/vehicle_positions
+#   python feed_columns.py --vehicles 1000
+
+import argparse
+from datetime import datetime
+import struct
+import time
+
+from google.protobuf.internal import api_implementation
+
+from gtfs_realtime_pb2 import FeedMessage, VehiclePosition
+import record
+
+
+# Whether protobuf parses messages in C (the cpp or upb implementations)
+NATIVE_PROTOBUF = api_implementation.Type() != "python"
+
+STATUS_NAMES = {number: name for name, number in
+                VehiclePosition.VehicleStopStatus.items()}
+DEFAULT_STATUS = VehiclePosition.DESCRIPTOR\
+    .fields_by_name["current_status"].default_value
+
+_FLOAT = struct.Struct("<f")
+
+_trip_starts = {}
+
+
+def format_start(start_date):
+    if start_date not in _trip_starts:
+        _trip_starts[start_date] = record.format_start(start_date)
+    return _trip_starts[start_date]
+
+
+def _varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(data, pos, end):
+    """Yields the (field number, wire type, value, position after the field)
+    of each field of the message in data[pos:end]. The value of a
+    length-delimited field is its start offset, and its end is the
+    position after the field. Fixed-width values are not decoded."""
+    while pos < end:
+        tag = data[pos]
+        if tag < 0x80:
+            pos += 1
+        else:
+            tag, pos = _varint(data, pos)
+        wire_type = tag & 7
+        if wire_type == 0:
+            value, pos = _varint(data, pos)
+        elif wire_type == 2:
+            length, value = _varint(data, pos)
+            pos = value + length
+        elif wire_type == 5:
+            value = pos
+            pos += 4
+        elif wire_type == 1:
+            value = pos
+            pos += 8
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield tag >> 3, wire_type, value, pos
+
+
+def _decode_vehicle(data, pos, end, columns):
+    trip_id = start_date = stop_id = vehicle_id = ""
+    stop_sequence = timestamp = 0
+    status = DEFAULT_STATUS
+    lat = lon = 0.0
+    for number, _, value, after in _fields(data, pos, end):
+        if number == 1:
+            for n, _, v, a in _fields(data, value, after):
+                if n == 1:
+                    trip_id = data[v:a].decode()
+                elif n == 3:
+                    start_date = data[v:a].decode()
+        elif number == 2:
+            for n, _, v, _ in _fields(data, value, after):
+                if n == 1:
+                    lat, = _FLOAT.unpack_from(data, v)
+                elif n == 2:
+                    lon, = _FLOAT.unpack_from(data, v)
+        elif number == 3:
+            stop_sequence = value
+        elif number == 4:
+            status = value
+        elif number == 5:
+            timestamp = value
+        elif number == 7:
+            stop_id = data[value:after].decode()
+        elif number == 8:
+            for n, _, v, a in _fields(data, value, after):
+                if n == 1:
+                    vehicle_id = data[v:a].decode()
+    columns["trip_id"].append(trip_id)
+    columns["trip_start"].append(format_start(start_date))
+    columns["stop_id"].append(stop_id)
+    columns["stop_sequence"].append(stop_sequence)
+    columns["vehicle_id"].append(vehicle_id)
+    # As protobuf does, read a status this version of the spec does not have
+    # as the default
+    columns["status"].append(STATUS_NAMES.get(status,
+                                              STATUS_NAMES[DEFAULT_STATUS]))
+    columns["timestamp"].append(timestamp)
+    columns["lat"].append(lat)
+    columns["lon"].append(lon)
+
+
+def _decode_wire(data):
+    columns = {field: [] for field in record.UPDATE_FIELDS}
+    header_timestamp = 0
+    for number, _, value, after in _fields(data, 0, len(data)):
+        if number == 1:
+            for n, _, v, _ in _fields(data, value, after):
+                if n == 3:
+                    header_timestamp = v
+        elif number == 2:
+            for n, _, v, a in _fields(data, value, after):
+                if n == 4:
+                    _decode_vehicle(data, v, a, columns)
+    return header_timestamp, columns
+
+
+def _decode_parsed(data):
+    message = FeedMessage()
+    message.ParseFromString(data)
+    columns = {field: [] for field in record.UPDATE_FIELDS}
+    appenders = [columns[field].append for field in record.UPDATE_FIELDS]
+    (trip_ids, trip_starts, stop_ids, stop_sequences, vehicle_ids, statuses,
+     timestamps, lats, lons) = appenders
+    for entity in message.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        vehicle = entity.vehicle
+        trip = vehicle.trip
+        position = vehicle.position
+        trip_ids(trip.trip_id)
+        trip_starts(format_start(trip.start_date))
+        stop_ids(vehicle.stop_id)
+        stop_sequences(vehicle.current_stop_sequence)
+        vehicle_ids(vehicle.vehicle.id)
+        statuses(STATUS_NAMES[vehicle.current_status])
+        timestamps(vehicle.timestamp)
+        lats(position.latitude)
+        lons(position.longitude)
+    return message.header.timestamp, columns
+
+
+def vehicle_position_columns(data):
+    """Returns the header timestamp of the serialized FeedMessage `data` and
+    a dict with a list for each of record.UPDATE_FIELDS, holding the values
+    that record.make_update_dict would give each vehicle position, except
+    that timestamps are seconds since the epoch."""
+    if NATIVE_PROTOBUF:
+        return _decode_parsed(data)
+    return _decode_wire(data)
+
+
+def column_updates(columns):
+    """Returns a dict like those of record.make_update_dict for each vehicle
+    in `columns`, the output of `vehicle_position_columns`."""
+    times = {t: datetime.fromtimestamp(t) for t in set(columns["timestamp"])}
+    fields = record.UPDATE_FIELDS
+    updates = [dict(zip(fields, values))
+               for values in zip(*(columns[field] for field in fields))]
+    for update in updates:
+        update["timestamp"] = times[update["timestamp"]]
+    return updates
+
+
+def parsed_updates(data):
+    """The dict-per-entity path, for comparison."""
+    message = FeedMessage()
+    message.ParseFromString(data)
+    return [record.make_update_dict(entity.vehicle)
+            for entity in message.entity if entity.HasField("vehicle")]
+
+
+def synthetic_feed(vehicles, timestamp=1542000000):
+    message = FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.timestamp = timestamp
+    for i in range(vehicles):
+        entity = message.entity.add(id=f"y{i}")
+        vehicle = entity.vehicle
+        vehicle.trip.trip_id = f"{37000000 + i}"
+        vehicle.trip.route_id = f"{i % 150}"
+        vehicle.trip.start_date = "20181112"
+        vehicle.trip.direction_id = i % 2
+        vehicle.vehicle.id = f"y{1000 + i}"
+        vehicle.vehicle.label = f"{1000 + i}"
+        vehicle.position.latitude = 42.35 + i * 1e-4
+        vehicle.position.longitude = -71.06 - i * 1e-4
+        vehicle.position.bearing = i % 360
+        vehicle.current_stop_sequence = i % 40
+        vehicle.current_status = i % 3
+        vehicle.timestamp = timestamp - i % 30
+        vehicle.stop_id = f"{70000 + i % 500}"
+    return message.SerializeToString()
+
+
+def sample_feeds(paths):
+    """Yields the serialized messages in `paths`, snapshot archives (or
+    directories of them) and .pb files."""
+    # replay uses this module
+    import replay
+
+    for path in paths:
+        if path.endswith(".pb"):
+            with open(path, "rb") as infile:
+                yield infile.read()
+        else:
+            for _, body in replay.iter_snapshots([path]):
+                yield body
+
+
+def benchmark(feeds, repeat=3):
+    """Times both extraction paths on each of `feeds` (serialized messages)
+    and checks that they agree. Returns the best total time of each."""
+    best = {}
+    for name, extract in [
+            ("parse + make_update_dict", parsed_updates),
+            ("vehicle_position_columns", vehicle_position_columns),
+            ("vehicle_position_columns + column_updates",
+             lambda data: column_updates(vehicle_position_columns(data)[1]))]:
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for data in feeds:
+                extract(data)
+            times.append(time.perf_counter() - started)
+        best[name] = min(times)
+
+    for data in feeds:
+        if parsed_updates(data) != \
+                column_updates(vehicle_position_columns(data)[1]):
+            raise AssertionError("The extraction paths disagree")
+    return best
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark vehicle position extraction")
+    parser.add_argument("paths", nargs="*",
+                        help="Snapshot archives, directories of them or .pb "
+                        "files (by default, a synthetic feed)")
+    parser.add_argument("--vehicles", type=int, default=800,
+                        help="Vehicles in the synthetic feed")
+    parser.add_argument("--limit", type=int, default=200,
+                        help="The most recorded feeds to use")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(args)
+
+    if args.paths:
+        feeds = []
+        for data in sample_feeds(args.paths):
+            feeds.append(data)
+            if len(feeds) >= args.limit:
+                break
+    else:
+        feeds = [synthetic_feed(args.vehicles)]
+    entities = sum(len(vehicle_position_columns(data)[1]["trip_id"])
+                   for data in feeds)
+
+    print(f"protobuf implementation: {api_implementation.Type()}; "
+          f"{len(feeds)} feeds, {entities} vehicles")
+    best = benchmark(feeds, args.repeat)
+    baseline = best["parse + make_update_dict"]
+    for name, seconds in best.items():
+        print(f"{name:44} {seconds * 1e6 / max(entities, 1):8.2f} us/vehicle"
+              f" {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
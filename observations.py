@@ -0,0 +1,317 @@
+# A compact, append-only binary format for the recorder's vehicle
+# observations, as an alternative to the daily CSV files.
+#
+# A file starts with MAGIC and continues with blocks. Each block is a one
+# byte kind, a little-endian uint32 payload length and the payload:
+#
+#  - b"D": new dictionary entries for one of STRING_COLUMNS: the column's
+#    index (one byte), then each entry as a uint16 length and UTF-8 bytes.
+#    A column's entries are numbered in the order they appear in the file.
+#  - b"R": observations, as packed ROW_DTYPE records. String columns hold
+#    dictionary codes, timestamps are seconds since the epoch and a
+#    stop_sequence of -1 is missing.
+#
+# Blocks are only ever appended, so a file can be written one poll at a
+# time. A torn block at the end (left by a crash) is ignored when reading,
+# and cut off before appending.
+#
+# To convert daily CSV files:
+#   python observations.py 2018-11-12.csv.gz ...
+
+import argparse
+import gzip
+import logging
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MBTAOBS1"
+SUFFIX = ".obs"
+
+STRING_COLUMNS = ["trip_id", "trip_start", "stop_id", "vehicle_id", "status"]
+ROW_DTYPE = np.dtype([("trip_id", "<u4"),
+                      ("trip_start", "<u4"),
+                      ("stop_id", "<u4"),
+                      ("stop_sequence", "<i4"),
+                      ("vehicle_id", "<u4"),
+                      ("status", "<u4"),
+                      ("timestamp", "<i8"),
+                      ("lat", "<f4"),
+                      ("lon", "<f4")])
+
+BLOCK_HEADER = struct.Struct("<cI")
+ENTRY_LENGTH = struct.Struct("<H")
+
+
+def is_observation_file(filepath):
+    return filepath.endswith(SUFFIX) or filepath.endswith(SUFFIX + ".gz")
+
+
+def read_blocks(data):
+    """Yields the (kind, payload) of each complete block in `data`, the
+    contents of an observation file, followed by (None, end) where `end` is
+    the offset just after the last complete block."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not an observation file")
+    pos = len(MAGIC)
+    view = memoryview(data)
+    while pos + BLOCK_HEADER.size <= len(data):
+        kind, length = BLOCK_HEADER.unpack_from(data, pos)
+        start = pos + BLOCK_HEADER.size
+        if start + length > len(data):
+            break
+        yield kind, view[start:start+length]
+        pos = start + length
+    yield None, pos
+
+
+def decode_entries(payload):
+    column = payload[0]
+    entries = []
+    pos = 1
+    while pos < len(payload):
+        length, = ENTRY_LENGTH.unpack_from(payload, pos)
+        pos += ENTRY_LENGTH.size
+        entries.append(bytes(payload[pos:pos+length]).decode("utf-8"))
+        pos += length
+    return column, entries
+
+
+def encode_entries(column, entries):
+    parts = [bytes([column])]
+    for entry in entries:
+        encoded = entry.encode("utf-8")
+        parts.append(ENTRY_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    payload = b"".join(parts)
+    return BLOCK_HEADER.pack(b"D", len(payload)) + payload
+
+
+class ObservationEncoder:
+    """Encodes observations as blocks, keeping the dictionaries of the file
+    they are appended to."""
+
+    def __init__(self):
+        self.codes = [{} for _ in STRING_COLUMNS]
+        # The number of entries of each dictionary already in the file
+        self.written = [0 for _ in STRING_COLUMNS]
+
+    @classmethod
+    def for_file(cls, path):
+        """Returns an encoder for appending to `path`, reading the
+        dictionaries already in it. A torn block at the end of the file is
+        cut off."""
+        encoder = cls()
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            return encoder
+        if not data:
+            return encoder
+
+        for kind, payload in read_blocks(data):
+            if kind == b"D":
+                column, entries = decode_entries(payload)
+                codes = encoder.codes[column]
+                for entry in entries:
+                    codes[entry] = len(codes)
+            elif kind is None and payload < len(data):
+                logger.warning("Truncating torn block at the end of %s", path)
+                os.truncate(path, payload)
+        encoder.mark_written()
+        return encoder
+
+    def mark_written(self):
+        """Records that everything encoded so far is in the file."""
+        self.written = [len(codes) for codes in self.codes]
+
+    def header(self):
+        """Returns what to write at the start of a new file: the magic
+        number and, if the file replaces one that was removed, the
+        dictionary entries that were in it."""
+        return MAGIC + b"".join(
+            encode_entries(column, list(codes)[:written])
+            for column, (codes, written)
+            in enumerate(zip(self.codes, self.written)) if written)
+
+    def encode_columns(self, columns):
+        """Returns the blocks for the observations in `columns`, a dict of
+        equal-length sequences for each column of ROW_DTYPE."""
+        n = len(columns["trip_id"])
+        rows = np.empty(n, dtype=ROW_DTYPE)
+        blocks = []
+        for column, name in enumerate(STRING_COLUMNS):
+            codes = self.codes[column]
+            inverse, uniques = pd.factorize(np.asarray(columns[name],
+                                                       dtype=object))
+            new = [value for value in uniques if value not in codes]
+            if new:
+                for value in new:
+                    codes[value] = len(codes)
+                blocks.append(encode_entries(column, new))
+            mapped = np.array([codes[value] for value in uniques],
+                              dtype=np.uint32)
+            rows[name] = mapped[inverse]
+        for name in ["stop_sequence", "timestamp", "lat", "lon"]:
+            rows[name] = columns[name]
+        payload = rows.tobytes()
+        blocks.append(BLOCK_HEADER.pack(b"R", len(payload)) + payload)
+        return b"".join(blocks)
+
+    def encode(self, updates):
+        """Returns the blocks for `updates`, dicts as made by
+        record.make_update_dict."""
+        updates = list(updates)
+        if not updates:
+            return b""
+        columns = {name: [update[name] for update in updates]
+                   for name in ROW_DTYPE.names}
+        columns["timestamp"] = [int(t.timestamp()) for t in
+                                columns["timestamp"]]
+        return self.encode_columns(columns)
+
+
+def read_file(filepath):
+    """Returns the observations in the file at `filepath` as a DataFrame.
+    String columns are categorical, with sorted categories and empty
+    strings missing, and timestamps are seconds since the epoch."""
+    opener = gzip.open if filepath.endswith(".gz") else open
+    with opener(filepath, "rb") as infile:
+        data = infile.read()
+
+    entries = [[] for _ in STRING_COLUMNS]
+    row_blocks = []
+    for kind, payload in read_blocks(data):
+        if kind == b"D":
+            column, new = decode_entries(payload)
+            entries[column].extend(new)
+        elif kind == b"R":
+            row_blocks.append(payload)
+        elif kind is None and payload < len(data):
+            logger.warning("Ignoring torn block at the end of %s", filepath)
+    rows = np.frombuffer(b"".join(row_blocks), dtype=ROW_DTYPE)
+
+    df = pd.DataFrame({name: rows[name] for name in ROW_DTYPE.names},
+                      columns=list(ROW_DTYPE.names))
+    for column, name in enumerate(STRING_COLUMNS):
+        categories = pd.Categorical.from_codes(
+            df[name].values.astype(np.int64), entries[column])
+        # Match pd.read_csv, which reads empty strings as missing and sorts
+        # the categories
+        if "" in categories.categories:
+            categories = categories.remove_categories([""])
+        categories = categories.remove_unused_categories()
+        df[name] = categories.reorder_categories(
+            categories.categories.sort_values())
+    missing = df["stop_sequence"] < 0
+    if missing.any():
+        df["stop_sequence"] = df["stop_sequence"].where(~missing)
+    return df
+
+
+def _file_blocks(infile, filepath):
+    """Yields the (kind, payload) of each complete block read from `infile`,
+    an open observation file positioned just after MAGIC."""
+    while True:
+        header = infile.read(BLOCK_HEADER.size)
+        if not header:
+            return
+        payload = b""
+        if len(header) == BLOCK_HEADER.size:
+            kind, length = BLOCK_HEADER.unpack(header)
+            payload = infile.read(length)
+        if len(header) < BLOCK_HEADER.size or len(payload) < length:
+            logger.warning("Ignoring torn block at the end of %s", filepath)
+            return
+        yield kind, payload
+
+
+def _decode_rows(data, entries):
+    rows = np.frombuffer(data, dtype=ROW_DTYPE)
+    df = pd.DataFrame({name: rows[name] for name in ROW_DTYPE.names},
+                      columns=list(ROW_DTYPE.names))
+    for column, name in enumerate(STRING_COLUMNS):
+        df[name] = np.asarray(entries[column], dtype=object)[df[name].values]
+    df["stop_sequence"] = df["stop_sequence"].where(df["stop_sequence"] >= 0)
+    return df
+
+
+def read_chunks(filepath, chunksize):
+    """Yields the observations in the file at `filepath` as DataFrames of
+    about `chunksize` rows (or more, if a single block is larger), reading
+    the file a block at a time. Unlike `read_file`, string columns hold
+    strings, with "" for empty values, and a missing stop_sequence is
+    NaN."""
+    opener = gzip.open if filepath.endswith(".gz") else open
+    entries = [[] for _ in STRING_COLUMNS]
+    pending = []
+    pending_rows = 0
+    with opener(filepath, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not an observation file")
+        for kind, payload in _file_blocks(infile, filepath):
+            if kind == b"D":
+                column, new = decode_entries(payload)
+                entries[column].extend(new)
+            elif kind == b"R":
+                pending.append(payload)
+                pending_rows += len(payload) // ROW_DTYPE.itemsize
+                if pending_rows >= chunksize:
+                    yield _decode_rows(b"".join(pending), entries)
+                    pending = []
+                    pending_rows = 0
+    if pending:
+        yield _decode_rows(b"".join(pending), entries)
+
+
+def convert_csv(csv_path, out_path=None):
+    """Converts the daily CSV file at `csv_path` to an observation file at
+    `out_path` (by default, the same name with SUFFIX in place of .csv or
+    .csv.gz). Returns the path written."""
+    if out_path is None:
+        base = os.path.basename(csv_path).split(".")[0]
+        out_path = os.path.join(os.path.dirname(csv_path), base + SUFFIX)
+
+    opener = gzip.open if csv_path.endswith(".gz") else open
+    with opener(csv_path, "rt") as f:
+        has_header = f.readline().startswith("trip_id")
+    df = pd.read_csv(csv_path, dtype="unicode",
+                     names=None if has_header else list(ROW_DTYPE.names))
+    timestamps = pd.to_datetime(df["timestamp"], utc=True)
+    columns = {name: df[name].fillna("").values for name in STRING_COLUMNS}
+    columns["timestamp"] = timestamps.values.astype("datetime64[s]")\
+                                            .astype(np.int64)
+    columns["stop_sequence"] = pd.to_numeric(df["stop_sequence"])\
+                                 .fillna(-1).values
+    for name in ["lat", "lon"]:
+        columns[name] = pd.to_numeric(df[name]).values
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as outfile:
+        encoder = ObservationEncoder()
+        outfile.write(encoder.header())
+        outfile.write(encoder.encode_columns(columns))
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Convert daily CSV files to observation files")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args(args)
+
+    for path in args.paths:
+        out_path = convert_csv(path)
+        print(f"{path} ({os.path.getsize(path)} bytes) -> {out_path} "
+              f"({os.path.getsize(out_path)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,38 @@
-from collections import defaultdict
+import argparse
+import asyncio
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from datetime import datetime
+from datetime import date, datetime
+import gzip
+import http.client
+import io
+import json
+import logging
+import math
+import random
+import signal
+import struct
 import time
 import os
+import zlib
 
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
 from urllib.request import urlopen
 
-from gtfs_realtime_pb2 import Alert, FeedMessage, VehiclePosition
+from google.protobuf.message import DecodeError
+
+import observations
+from gtfs_realtime_pb2 import Alert, FeedHeader, FeedMessage, VehiclePosition
+
+
+logger = logging.getLogger(__name__)
 
 
 VehiclePositionsUrl = "https://cdn.mbta.com/realtime/VehiclePositions.pb"
 AlertsUrl = "https://cdn.mbta.com/realtime/Alerts.pb"
+TripUpdatesUrl = "https://cdn.mbta.com/realtime/TripUpdates.pb"
 
 try:
     DEFAULT_BASE_DIR = os.path.join(os.path.dirname(__file__), "updates")
@@ -20,15 +41,459 @@ except NameError as _:
 
 BASE_DIR = os.environ.get("MBTA_UPDATES_DIR", DEFAULT_BASE_DIR)
 
+# How often (in polls) run() logs the poller counters
+STATS_INTERVAL = int(os.environ.get("MBTA_RECORD_STATS_INTERVAL", 240))
+
+# Seconds between polls of the vehicle positions feed in run()
+POLL_INTERVAL = float(os.environ.get("MBTA_RECORD_INTERVAL", 15))
+
+# Polls of each feed are spread by up to this fraction of its interval
+POLL_JITTER = float(os.environ.get("MBTA_RECORD_JITTER", 0.1))
+
+# Seconds after a feed's expected update to poll it, allowing for clock skew
+# and publishing delay
+POLL_MARGIN = 1.0
+
+# Upper limit on the delay between polls after repeated errors
+MAX_BACKOFF = 300
+
+# Fetched messages waiting for a feed's writer. When the queue is full, that
+# feed's poller waits; the other feeds are unaffected.
+WRITE_QUEUE_SIZE = 4
+
+# Whether to archive the raw messages of each feed, and how to compress them
+ARCHIVE_SNAPSHOTS = bool(os.environ.get("MBTA_ARCHIVE_SNAPSHOTS"))
+SNAPSHOT_COMPRESSION = os.environ.get("MBTA_SNAPSHOT_COMPRESSION", "gzip")
+SNAPSHOT_SUFFIXES = {"gzip": ".pb.gz", "zstd": ".pb.zst"}
+SNAPSHOT_HEADER = struct.Struct("<QI")
+
+# The format of the vehicle position files: "csv" for the daily CSV files or
+# "obs" for the binary format of observations.py
+RECORD_FORMAT = os.environ.get("MBTA_RECORD_FORMAT", "csv")
+
+# Buffered rows are written to each file when they reach this size, or
+# after this many seconds
+WRITER_FLUSH_BYTES = int(os.environ.get("MBTA_WRITER_FLUSH_KB", 64)) * 1024
+WRITER_FLUSH_INTERVAL = float(os.environ.get("MBTA_WRITER_FLUSH_SECONDS", 60))
+# When to fsync files: "always" (after every flush), "close" or "never"
+WRITER_FSYNC = os.environ.get("MBTA_WRITER_FSYNC", "close")
+# Files that have not been written to for this long are closed
+WRITER_IDLE_SECONDS = float(os.environ.get("MBTA_WRITER_IDLE_SECONDS", 3600))
+
+# The number of vehicles whose last report is remembered, and how often (in
+# seconds) the reports are saved
+LAST_SEEN_MAX_SIZE = int(os.environ.get("MBTA_LAST_SEEN_MAX_SIZE", 10000))
+LAST_SEEN_SAVE_INTERVAL = 60
+
+UPDATE_FIELDS = ["trip_id", "trip_start", "stop_id", "stop_sequence",
+                 "vehicle_id", "status", "timestamp", "lat", "lon"]
+TRIP_UPDATE_FIELDS = ["trip_id", "trip_start", "route_id", "vehicle_id",
+                      "stop_id", "stop_sequence", "arrival_time",
+                      "arrival_delay", "departure_time", "departure_delay",
+                      "schedule_relationship", "timestamp"]
+ALERT_FIELDS = ["alert_id", "header", "description", "effect"]
+
+
+# The errors that parsing a malformed feed can raise, whether with protobuf or
+# with the decoder of feed_columns.py
+PARSE_ERRORS = (DecodeError, ValueError, IndexError, KeyError, struct.error)
+
+
+def header_timestamp(body):
+    """Returns header.timestamp of the serialized FeedMessage `body` without
+    parsing the entities, or None if the header does not come first."""
+    # The header is field 1 (tag 0x0a), and serializers write it first
+    if not body or body[0] != 0x0a:
+        return None
+    length, shift, pos = 0, 0, 1
+    while pos < len(body):
+        byte = body[pos]
+        pos += 1
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    header = FeedHeader()
+    try:
+        header.ParseFromString(body[pos:pos+length])
+    except DecodeError:
+        return None
+    return header.timestamp
+
+
+class FeedPoller:
+    """Polls a GTFS-realtime feed over a persistent keep-alive connection.
+
+    Requests are conditional on the ETag and Last-Modified of the last
+    response. `fetch` returns parse(body), by default a FeedMessage (see
+    `parse_feed_message`), or None, without parsing the body, when the
+    server answers 304 Not Modified or the feed's header timestamp has not
+    changed. `stats` counts requests, connections opened, responses that
+    were skipped and the bytes received and saved by 304s. `timestamp` is
+    the header timestamp of the latest feed, and `failed` is True if the
+    last fetch raised an error.
+    """
+
+    def __init__(self, url, timeout=30, parse=None):
+        parts = urlsplit(url)
+        self.url = url
+        self.parse = parse or parse_feed_message
+        self.https = parts.scheme == "https"
+        self.host = parts.netloc
+        self.path = parts.path + (f"?{parts.query}" if parts.query else "")
+        self.timeout = timeout
+        self.conn = None
+        self.etag = None
+        self.last_modified = None
+        self.timestamp = None
+        self.size = 0
+        self.failed = False
+        # A SnapshotArchive to append each new feed to, if any
+        self.archive = None
+        self.stats = Counter()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, headers):
+        if not self.conn:
+            cls = http.client.HTTPSConnection if self.https \
+                else http.client.HTTPConnection
+            self.conn = cls(self.host, timeout=self.timeout)
+            self.stats["connections"] += 1
+        self.conn.request("GET", self.path, headers=headers)
+        response = self.conn.getresponse()
+        # Always read the body so that the connection can be reused
+        return response, response.read()
+
+    def fetch(self):
+        self.failed = True
+        message = self._fetch()
+        self.failed = False
+        return message
+
+    def _fetch(self):
+        headers = {"Accept-Encoding": "identity"}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        self.stats["requests"] += 1
+        try:
+            try:
+                response, body = self._request(headers)
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle keep-alive connection
+                self.close()
+                response, body = self._request(headers)
+        except (http.client.HTTPException, OSError) as err:
+            self.close()
+            self.stats["errors"] += 1
+            raise URLError(err)
+
+        if response.getheader("Connection", "").lower() == "close":
+            self.close()
+        self.stats["bytes_received"] += len(body)
+
+        if response.status == 304:
+            self.stats["not_modified"] += 1
+            self.stats["bytes_saved"] += self.size
+            return None
+        if response.status != 200:
+            self.stats["errors"] += 1
+            raise HTTPError(self.url, response.status, response.reason,
+                            response.msg, None)
+
+        self.etag = response.getheader("ETag")
+        self.last_modified = response.getheader("Last-Modified")
+        self.size = len(body)
+
+        timestamp = header_timestamp(body)
+        if timestamp and timestamp == self.timestamp:
+            self.stats["unchanged"] += 1
+            return None
+
+        if self.archive:
+            try:
+                self.archive.append(body)
+            except OSError:
+                logger.exception("Error archiving %s", self.url)
+
+        self.timestamp, message = self.parse(body)
+        self.stats["updated"] += 1
+        return message
+
+    def log_stats(self):
+        stats = self.stats
+        logger.info("%s: %d requests (%d connections), %d not modified, "
+                    "%d unchanged, %d updated, %d errors; "
+                    "%d bytes received, %d bytes saved",
+                    self.url, stats["requests"], stats["connections"],
+                    stats["not_modified"], stats["unchanged"],
+                    stats["updated"], stats["errors"],
+                    stats["bytes_received"], stats["bytes_saved"])
+
+
+class PollScheduler:
+    """Decides when to poll a feed.
+
+    Polls are aligned to ticks `interval` seconds apart, anchored to the
+    feed's last header timestamp (or to the epoch until one is known), so
+    the time spent fetching and writing does not push later polls back.
+    The feed's update period is learned from the changes in its header
+    timestamp. When it is at least `interval`, polls are scheduled just
+    after each expected update instead, and repeated every eighth of a
+    period while an update is late. Polls that find an expected update
+    missing also teach the scheduler how long after its header timestamp
+    a feed is published. After an error, polls back off exponentially,
+    with full jitter.
+
+    `stats` counts polls, updates, errors and missed ticks (ticks that
+    passed while a poll was still running), and `lag` is the number of
+    seconds between the latest feed's header timestamp and the poll that
+    first saw it.
+    """
+
+    def __init__(self, interval, jitter=0.0, margin=POLL_MARGIN,
+                 history=20):
+        self.interval = interval
+        self.jitter = jitter
+        self.margin = margin
+        self.periods = deque(maxlen=history)
+        # How long after an expected update polls have found it missing
+        self.misses = deque(maxlen=history)
+        self.feed_timestamp = None
+        self.lag = None
+        self.errors = 0
+        self.scheduled = None
+        self.stats = Counter()
+
+    @property
+    def period(self):
+        """The median of the recently observed update periods, or None."""
+        if not self.periods:
+            return None
+        periods = sorted(self.periods)
+        return periods[len(periods) // 2]
+
+    @property
+    def publish_delay(self):
+        return max(self.misses, default=0)
+
+    def record(self, started, feed_timestamp, failed=False, now=None):
+        """Records a poll that started at `started` (in epoch seconds) and
+        saw a feed with the header timestamp `feed_timestamp`."""
+        now = time.time() if now is None else now
+        self.stats["polls"] += 1
+        if self.scheduled is not None:
+            self.stats["missed_ticks"] += \
+                int(max(0, now - self.scheduled) // self.interval)
+
+        if failed:
+            self.errors += 1
+            self.stats["errors"] += 1
+            return
+        self.errors = 0
+
+        if not feed_timestamp:
+            return
+        if feed_timestamp == self.feed_timestamp:
+            period = self.period
+            if period and period >= self.interval:
+                late = started - (feed_timestamp + period)
+                if 0 <= late < period:
+                    self.misses.append(late)
+            return
+
+        if self.feed_timestamp:
+            self.periods.append(feed_timestamp - self.feed_timestamp)
+        self.feed_timestamp = feed_timestamp
+        self.lag = started - feed_timestamp
+        self.stats["updates"] += 1
+        self.stats["total_lag"] += self.lag
+
+    def next_poll(self, now=None):
+        """Returns the time (in epoch seconds) of the next poll."""
+        now = time.time() if now is None else now
+        if self.errors:
+            backoff = min(MAX_BACKOFF, self.interval * 2 ** (self.errors - 1))
+            self.scheduled = now + random.uniform(self.margin, backoff)
+            return self.scheduled
+
+        step = self.interval
+        anchor = self.margin
+        if self.feed_timestamp:
+            anchor += self.feed_timestamp + self.publish_delay
+            period = self.period
+            if period and period >= self.interval:
+                expected = anchor + period
+                if now < expected:
+                    step, anchor = period, expected
+                elif now - expected < period:
+                    # The update is late; check again soon
+                    step, anchor = period / 8, expected
+
+        # Never wait more than a step, even if the feed's clock is ahead
+        ticks = math.floor((now - anchor) / step) + 1
+        self.scheduled = min(anchor + max(0, ticks) * step, now + step) + \
+            random.uniform(0, self.jitter * step)
+        return self.scheduled
+
+    def delay(self, now=None):
+        now = time.time() if now is None else now
+        return max(0, self.next_poll(now) - now)
+
+    def log_stats(self, name):
+        stats = self.stats
+        mean_lag = stats["total_lag"] / stats["updates"] \
+            if stats["updates"] else float("nan")
+        logger.info("%s: %d polls, %d updates, %d errors, %d missed ticks; "
+                    "update period %s s, publish delay %.1f s, "
+                    "lag %.1f s (mean %.1f s)",
+                    name, stats["polls"], stats["updates"], stats["errors"],
+                    stats["missed_ticks"], self.period, self.publish_delay,
+                    self.lag if self.lag is not None else float("nan"),
+                    mean_lag)
+
+
+class SnapshotArchive:
+    """Appends raw feed messages to a rolling archive in `directory`, one
+    file per UTC hour, named YYYY-mm-ddTHH.pb.gz (or .pb.zst). Each record
+    is the fetch time in milliseconds since the epoch and the message
+    length, packed as SNAPSHOT_HEADER, followed by the message. Files are
+    compressed with `compression`, "gzip" or "zstd" (which requires the
+    zstandard package), and flushed after every record so that a crash
+    loses at most the record being written. A file is never appended to
+    once closed, since a crash leaves its compressed stream unfinished: if
+    the hour's file already exists (after a restart), the next one is
+    named YYYY-mm-ddTHH.1.pb.gz, and so on (see `snapshot_sort_key`)."""
+
+    def __init__(self, directory, compression=SNAPSHOT_COMPRESSION):
+        if compression not in SNAPSHOT_SUFFIXES:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.directory = directory
+        self.compression = compression
+        self.hour = None
+        self.raw = None
+        self.file = None
+
+    def _open(self, hour):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        suffix = SNAPSHOT_SUFFIXES[self.compression]
+        path = os.path.join(self.directory, hour + suffix)
+        sequence = 0
+        while os.path.exists(path):
+            sequence += 1
+            path = os.path.join(self.directory, f"{hour}.{sequence}{suffix}")
+        self.raw = open(path, "xb")
+        if self.compression == "zstd":
+            import zstandard
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="ab")
+        self.hour = hour
+
+    def append(self, body, fetched=None):
+        fetched = time.time() if fetched is None else fetched
+        hour = time.strftime("%Y-%m-%dT%H", time.gmtime(fetched))
+        if hour != self.hour:
+            self._open(hour)
+        self.file.write(SNAPSHOT_HEADER.pack(int(fetched * 1000), len(body)))
+        self.file.write(body)
+        self.file.flush()
+        self.raw.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.raw.close()
+            self.file = self.raw = self.hour = None
+
+
+def snapshot_sort_key(path):
+    """Orders snapshot archive files chronologically, by hour and then by
+    the sequence number added to the files of an hour after a restart."""
+    hour, _, rest = os.path.basename(path).partition(".")
+    sequence = rest.split(".")[0]
+    return hour, int(sequence) if sequence.isdigit() else 0
+
+
+def read_snapshots(path):
+    """Yields the (fetch time in seconds, message bytes) of each record in
+    the snapshot archive file at `path`, stopping at a truncated or
+    corrupt record."""
+    errors = (EOFError, OSError, struct.error, zlib.error)
+    with open(path, "rb") as raw:
+        if path.endswith(SNAPSHOT_SUFFIXES["zstd"]):
+            import zstandard
+            infile = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True)
+            errors += (zstandard.ZstdError,)
+        else:
+            infile = gzip.GzipFile(fileobj=raw)
+        while True:
+            try:
+                header = infile.read(SNAPSHOT_HEADER.size)
+                if not header:
+                    return
+                fetched, length = SNAPSHOT_HEADER.unpack(header)
+                body = infile.read(length)
+                if len(body) < length:
+                    raise EOFError
+            except errors:
+                # Left by a crash while writing
+                logger.warning("Ignoring truncated snapshot in %s", path)
+                return
+            yield fetched / 1000, body
+
+
+def snapshot_dir(name):
+    return os.path.join(BASE_DIR, "snapshots", name)
+
+
+_pollers = {}
+_schedulers = {}
+
+
+def get_poller(url, parse=None):
+    """Returns the poller for `url`, which parses feeds with `parse` if it
+    is new (see FeedPoller)."""
+    if url not in _pollers:
+        _pollers[url] = FeedPoller(url, parse=parse)
+    return _pollers[url]
+
+
+def parse_feed_message(body):
+    """Returns the header timestamp and the FeedMessage parsed from `body`."""
+    message = FeedMessage()
+    message.ParseFromString(body)
+    return message.header.timestamp, message
+
+
+def parse_vehicle_positions(body):
+    """Returns the header timestamp of the vehicle positions feed `body` and
+    its vehicles as columns, which is much faster than parsing the message
+    (see feed_columns.py)."""
+    # feed_columns imports this module
+    import feed_columns
+    return feed_columns.vehicle_position_columns(body)
+
 
 def get_vehicle_positions(url=VehiclePositionsUrl):
+    """Returns the vehicles in the feed at `url` as columns (see
+    `parse_vehicle_positions`), or None if the feed has not changed since
+    the last call."""
     try:
-        with urlopen(url) as u:
-            message = FeedMessage()
-            message.ParseFromString(u.read())
-            return filter(None, (entity.vehicle for entity in message.entity))
+        return get_poller(url, parse_vehicle_positions).fetch()
     except URLError:
-        return []
+        return None
+    except PARSE_ERRORS as err:
+        logger.warning("Error parsing %s: %s", url, err)
+        return None
 
 
 def get_alerts(url=AlertsUrl):
@@ -76,33 +541,551 @@ def make_update_dict(vehicle):
             "lon": pos.longitude}
 
 
+def optional_time(timestamp):
+    return datetime.fromtimestamp(timestamp) if timestamp else None
+
+
+def make_trip_update_dicts(trip_update):
+    trip = trip_update.trip
+    for stop_time in trip_update.stop_time_update:
+        relationship = trip_update.StopTimeUpdate.ScheduleRelationship.Name(
+            stop_time.schedule_relationship)
+        yield {"trip_id": trip.trip_id,
+               "trip_start": format_start(trip.start_date),
+               "route_id": trip.route_id,
+               "vehicle_id": trip_update.vehicle.id,
+               "stop_id": stop_time.stop_id,
+               "stop_sequence": stop_time.stop_sequence,
+               "arrival_time": optional_time(stop_time.arrival.time),
+               "arrival_delay": stop_time.arrival.delay,
+               "departure_time": optional_time(stop_time.departure.time),
+               "departure_delay": stop_time.departure.delay,
+               "schedule_relationship": relationship,
+               "timestamp": optional_time(trip_update.timestamp)}
+
+
+class LastSeen:
+    """Remembers the trip and timestamp of the last report written for each
+    vehicle, so that a report is only written once however many polls
+    return it.
+
+    At most `max_size` vehicles are remembered, dropping the least recently
+    updated. The map is saved to `path` by `save`, and loaded from it on
+    creation, so that a restarted recorder does not write the reports it
+    has already written again. It must only be saved once the reports it
+    records are in the files (see `sync_last_seen`): a report that was
+    filtered but never written out would otherwise be skipped for good.
+    """
+
+    def __init__(self, path, max_size=LAST_SEEN_MAX_SIZE,
+                 save_interval=LAST_SEEN_SAVE_INTERVAL):
+        self.path = path
+        self.max_size = max_size
+        self.save_interval = save_interval
+        self.seen = OrderedDict()
+        self.saved = time.time()
+        self.stats = Counter()
+        try:
+            with open(path) as infile:
+                for vehicle, trip_id, timestamp in json.load(infile):
+                    self.seen[vehicle] = (trip_id, timestamp)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError):
+            logger.warning("Ignoring unreadable %s", path)
+
+    def filter(self, updates):
+        """Yields the update dicts in `updates` that have not been seen."""
+        for update in updates:
+            vehicle = update["vehicle_id"] or update["trip_id"]
+            value = (update["trip_id"], str(update["timestamp"]))
+            self.stats["updates"] += 1
+            if self.seen.get(vehicle) == value:
+                self.stats["duplicates"] += 1
+                continue
+            self.seen[vehicle] = value
+            self.seen.move_to_end(vehicle)
+            if len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+            yield update
+
+    def due(self):
+        """Returns True if `save_interval` seconds have passed since the
+        last save."""
+        return time.time() - self.saved >= self.save_interval
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as outfile:
+            json.dump([[vehicle, trip_id, timestamp] for
+                       vehicle, (trip_id, timestamp) in self.seen.items()],
+                      outfile)
+        os.replace(tmp_path, self.path)
+        self.saved = time.time()
+
+    def log_stats(self):
+        logger.info("%d vehicle updates, %d duplicates not written",
+                    self.stats["updates"], self.stats["duplicates"])
+
+
+_last_seen = None
+
+
+def get_last_seen():
+    global _last_seen
+    if _last_seen is None:
+        _last_seen = LastSeen(os.path.join(BASE_DIR, "last_seen.json"))
+    return _last_seen
+
+
+def save_last_seen():
+    if _last_seen is not None:
+        try:
+            _last_seen.save()
+        except OSError:
+            logger.exception("Error saving %s", _last_seen.path)
+
+
+def sync_last_seen(writer):
+    """Saves the vehicles seen once their save is due, after flushing
+    `writer`, the writer of the reports they were filtered for."""
+    if _last_seen is not None and _last_seen.due():
+        writer.flush()
+        save_last_seen()
+
+
+def new_updates(vehicles):
+    """Returns the update dicts for the reports in `vehicles` that have not
+    already been written."""
+    return get_last_seen().filter(map(make_update_dict, vehicles))
+
+
+def vehicle_position_rows(columns):
+    """Returns the update dicts for the vehicles in `columns` (see
+    `parse_vehicle_positions`) that have not already been written."""
+    import feed_columns
+    return get_last_seen().filter(feed_columns.column_updates(columns))
+
+
+# For each trip in the last trip updates message, its timestamp and the
+# prediction last written for each of its stops, so that a stop time update
+# is only written again when it changes. Trips that leave the feed are
+# forgotten.
+_last_predictions = {}
+
+
+def trip_update_rows(message):
+    global _last_predictions
+    predictions = {}
+    for entity in message.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip_update = entity.trip_update
+        trip = (trip_update.trip.trip_id, trip_update.trip.start_date)
+        timestamp, last = _last_predictions.get(trip, (None, {}))
+        if trip_update.timestamp and trip_update.timestamp == timestamp:
+            predictions[trip] = (timestamp, last)
+            continue
+        stops = {}
+        for row in make_trip_update_dicts(trip_update):
+            key = (row["stop_sequence"], row["stop_id"])
+            prediction = (row["vehicle_id"], row["arrival_time"],
+                          row["arrival_delay"], row["departure_time"],
+                          row["departure_delay"],
+                          row["schedule_relationship"])
+            stops[key] = prediction
+            if last.get(key) != prediction:
+                yield row
+        predictions[trip] = (trip_update.timestamp, stops)
+    _last_predictions = predictions
+
+
+# The last alert dict written for each alert_id, so that an alert is only
+# written again when it changes
+_last_alerts = {}
+
+
+def alert_rows(message):
+    for entity in message.entity:
+        if entity.HasField("alert"):
+            alert_dict = make_alert_dict(entity)
+            if _last_alerts.get(entity.id) != alert_dict:
+                _last_alerts[entity.id] = alert_dict
+                yield alert_dict
+
+
+def trip_start_key(row):
+    return row["trip_start"]
+
+
+def today_key(_row):
+    return date.today().isoformat()
+
+
+class CsvEncoder:
+    """Encodes rows as CSV text with the columns in `fields`."""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def _text(self, write):
+        buf = io.StringIO()
+        write(csv.DictWriter(buf, self.fields))
+        return buf.getvalue()
+
+    def header(self):
+        return self._text(lambda writer: writer.writeheader())
+
+    def encode(self, rows):
+        return self._text(lambda writer: writer.writerows(rows))
+
+    def mark_written(self):
+        pass
+
+
+# Maps each output format to its file suffix, the mode to open files in and a
+# function that makes an encoder for a file given the fields and path. Only
+# the vehicle position updates can be written as observation files.
+FORMATS = {
+    "csv": (".csv", "a", lambda fields, path: CsvEncoder(fields)),
+    "obs": (observations.SUFFIX, "ab",
+            lambda fields, path:
+                observations.ObservationEncoder.for_file(path)),
+}
+
+
+class UpdateWriter:
+    """Appends rows to files in `base_dir` in the format `fmt` (a key of
+    FORMATS), keeping one open handle per file.
+
+    Rows are encoded and buffered in memory, and written out when a file's
+    buffer reaches `flush_bytes` or `flush_interval` seconds have passed
+    since it was last flushed. `fsync` is "always" (fsync after every
+    flush), "close" (only when a file is closed) or "never". A file that
+    has not been written to for `idle_seconds`, such as a past service
+    date's, is flushed and closed. These checks happen only in `write` and
+    `flush_due`, so a caller that can go a while without new rows should
+    call `flush_due` regularly, and `close` before exiting.
+    """
+
+    def __init__(self, base_dir, fields, fmt="csv",
+                 flush_bytes=WRITER_FLUSH_BYTES,
+                 flush_interval=WRITER_FLUSH_INTERVAL, fsync=WRITER_FSYNC,
+                 idle_seconds=WRITER_IDLE_SECONDS):
+        if fsync not in ("always", "close", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.base_dir = base_dir
+        self.fields = fields
+        self.suffix, self.mode, self.make_encoder = FORMATS[fmt]
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.idle_seconds = idle_seconds
+        # name -> [file, encoder, buffered chunks, buffered size,
+        #          time of last flush, time of last write]
+        self.files = {}
+
+    def _open(self, name, now):
+        path = os.path.join(self.base_dir, name + self.suffix)
+        encoder = self.make_encoder(self.fields, path)
+        outfile = open(path, self.mode)
+        if outfile.tell() == 0:
+            outfile.write(encoder.header())
+        self.files[name] = entry = [outfile, encoder, [], 0, now, now]
+        return entry
+
+    def write(self, rows, key, now=None):
+        """Buffers `rows` (dicts with the keys in `fields`) for the file named
+        key(row) and flushes or closes any files that are due."""
+        now = time.time() if now is None else now
+        grouped = defaultdict(list)
+        for row in rows:
+            grouped[key(row)].append(row)
+
+        for name, group in grouped.items():
+            entry = self.files.get(name) or self._open(name, now)
+            data = entry[1].encode(group)
+            entry[2].append(data)
+            entry[3] += len(data)
+            entry[5] = now
+        self.flush_due(now)
+
+    def flush_due(self, now=None):
+        """Flushes or closes any files that are due."""
+        now = time.time() if now is None else now
+        for name, entry in list(self.files.items()):
+            if now - entry[5] >= self.idle_seconds:
+                self.close_file(name)
+            elif entry[3] >= self.flush_bytes or \
+                    now - entry[4] >= self.flush_interval:
+                self.flush_file(name, now)
+
+    def flush_file(self, name, now=None):
+        outfile, encoder, chunks, _, _, _ = entry = self.files[name]
+        if chunks:
+            if self._replaced(outfile):
+                # The file was moved or removed (by dump.sh, say) while it
+                # was open, so start a new one
+                outfile.close()
+                outfile = entry[0] = open(outfile.name, self.mode)
+                if outfile.tell() == 0:
+                    outfile.write(encoder.header())
+            outfile.write(chunks[0][:0].join(chunks))
+            outfile.flush()
+            encoder.mark_written()
+            if self.fsync == "always":
+                os.fsync(outfile.fileno())
+            entry[2] = []
+            entry[3] = 0
+        entry[4] = time.time() if now is None else now
+
+    @staticmethod
+    def _replaced(outfile):
+        """Returns True if the path `outfile` was opened at no longer refers
+        to it."""
+        try:
+            st = os.stat(outfile.name)
+        except FileNotFoundError:
+            return True
+        open_st = os.fstat(outfile.fileno())
+        return (st.st_dev, st.st_ino) != (open_st.st_dev, open_st.st_ino)
+
+    def flush(self):
+        for name in list(self.files):
+            self.flush_file(name)
+
+    def close_file(self, name):
+        self.flush_file(name)
+        outfile = self.files.pop(name)[0]
+        if self.fsync != "never":
+            os.fsync(outfile.fileno())
+        outfile.close()
+
+    def close(self):
+        for name in list(self.files):
+            self.close_file(name)
+
+
+_writers = {}
+
+
+def get_writer(base_dir, fields, fmt="csv"):
+    if base_dir not in _writers:
+        _writers[base_dir] = UpdateWriter(base_dir, fields, fmt)
+    return _writers[base_dir]
+
+
+def close_writers():
+    """Closes the writers, returning False if any of their files could not
+    be written out."""
+    closed = True
+    for writer in _writers.values():
+        try:
+            writer.close()
+        except OSError:
+            logger.exception("Error closing files in %s", writer.base_dir)
+            closed = False
+    return closed
+
+
+def flush_writers():
+    for writer in _writers.values():
+        writer.flush_due()
+
+
 def store_latest_updates():
-    grouped_updates = defaultdict(list)
-    for vehicle in get_vehicle_positions():
-        update_dict = make_update_dict(vehicle)
-        grouped_updates[update_dict["trip_start"]].append(update_dict)
-
-    for trip_start, updates in grouped_updates.items():
-        with open(os.path.join(BASE_DIR, f"{trip_start}.csv"), "a") as outfile:
-            writer = csv.DictWriter(outfile,
-                                    ["trip_id", "trip_start", "stop_id",
-                                     "stop_sequence", "vehicle_id", "status",
-                                     "timestamp", "lat", "lon"])
-            if outfile.tell() == 0:
-                writer.writeheader()
-            writer.writerows(updates)
-
-
-def run():
+    columns = get_vehicle_positions()
+    writer = get_writer(BASE_DIR, UPDATE_FIELDS, RECORD_FORMAT)
+    if columns is not None:
+        writer.write(vehicle_position_rows(columns), trip_start_key)
+    sync_last_seen(writer)
+
+
+# A feed for the async recorder. Each new feed is parsed with parse(body)
+# (see FeedPoller), and the rows for it are made with rows(parsed) and
+# appended, in the format `fmt`, to the file named key(row) in the
+# subdirectory `subdir` of BASE_DIR.
+Feed = namedtuple("Feed", ["name", "url", "interval", "parse", "rows", "key",
+                           "fields", "subdir", "fmt"])
+
+FEEDS = {
+    # Vehicle positions go where store_latest_updates has always put them,
+    # which is where dump.sh and upload.sh look for them.
+    "vehicle_positions": Feed("vehicle_positions", VehiclePositionsUrl,
+                              float(os.environ.get(
+                                  "MBTA_VEHICLE_POSITIONS_INTERVAL", 15)),
+                              parse_vehicle_positions, vehicle_position_rows,
+                              trip_start_key, UPDATE_FIELDS, "", RECORD_FORMAT),
+    "trip_updates": Feed("trip_updates", TripUpdatesUrl,
+                         float(os.environ.get(
+                             "MBTA_TRIP_UPDATES_INTERVAL", 15)),
+                         parse_feed_message, trip_update_rows, trip_start_key,
+                         TRIP_UPDATE_FIELDS, "trip_updates", "csv"),
+    "alerts": Feed("alerts", AlertsUrl,
+                   float(os.environ.get("MBTA_ALERTS_INTERVAL", 60)),
+                   parse_feed_message, alert_rows, today_key,
+                   ALERT_FIELDS, "alerts", "csv"),
+}
+
+
+def feed_dir(feed):
+    return os.path.join(BASE_DIR, feed.subdir)
+
+
+def write_feed_message(feed, message):
+    writer = get_writer(feed_dir(feed), feed.fields, feed.fmt)
+    writer.write(feed.rows(message), feed.key)
+    if feed.rows is vehicle_position_rows:
+        # Only from the thread that filters vehicle reports
+        sync_last_seen(writer)
+
+
+async def poll_feed(feed, queue, executor):
+    """Fetches `feed` about every feed.interval seconds (see PollScheduler)
+    and puts new messages on `queue`, or None after a poll that brought
+    nothing new, so that the writer still flushes rows that are due."""
+    loop = asyncio.get_event_loop()
+    poller = get_poller(feed.url, feed.parse)
+    scheduler = _schedulers[feed.name] = \
+        PollScheduler(feed.interval, jitter=POLL_JITTER)
+    while True:
+        started = time.time()
+        try:
+            message = await loop.run_in_executor(executor, poller.fetch)
+        except (URLError,) + PARSE_ERRORS as err:
+            logger.warning("Error fetching %s: %s", feed.name, err)
+            message = None
+        except Exception:
+            logger.exception("Error fetching %s", feed.name)
+            message = None
+        await queue.put(message)
+
+        scheduler.record(started, poller.timestamp, poller.failed)
+        await asyncio.sleep(scheduler.delay())
+
+
+async def write_feed(feed, queue, executor):
+    """Writes the messages on `queue` for `feed`."""
+    loop = asyncio.get_event_loop()
+    writer = get_writer(feed_dir(feed), feed.fields, feed.fmt)
+    while True:
+        message = await queue.get()
+        try:
+            if message is None:
+                await loop.run_in_executor(executor, writer.flush_due)
+            else:
+                await loop.run_in_executor(executor, write_feed_message,
+                                           feed, message)
+        except Exception:
+            logger.exception("Error writing %s", feed.name)
+
+
+async def record_feeds(feeds):
+    """Polls and records each of `feeds` concurrently. Each feed has its own
+    fetching and writing threads, so a slow feed does not hold up the
+    others."""
+    tasks = []
+    for feed in feeds:
+        os.makedirs(feed_dir(feed), exist_ok=True)
+        queue = asyncio.Queue(WRITE_QUEUE_SIZE)
+        tasks.append(poll_feed(feed, queue, ThreadPoolExecutor(1)))
+        tasks.append(write_feed(feed, queue, ThreadPoolExecutor(1)))
+    await asyncio.gather(*tasks)
+
+
+def archive_feeds(names):
+    """Archives the raw messages of the feeds `names` (see
+    SnapshotArchive)."""
+    for name in names:
+        feed = FEEDS[name]
+        get_poller(feed.url, feed.parse).archive = \
+            SnapshotArchive(snapshot_dir(name))
+
+
+def close_archives():
+    for poller in _pollers.values():
+        if poller.archive:
+            poller.archive.close()
+
+
+def run_feeds(names=FEEDS.keys(), archive=ARCHIVE_SNAPSHOTS):
+    if archive:
+        archive_feeds(names)
+    try:
+        asyncio.run(record_feeds([FEEDS[name] for name in names]))
+    except KeyboardInterrupt:
+        log_poller_stats()
+        print("Exiting")
+    finally:
+        # Saving the vehicles seen after a failed close would skip the
+        # unwritten reports when the recorder restarts
+        if close_writers():
+            save_last_seen()
+        close_archives()
+
+
+def log_poller_stats():
+    for poller in _pollers.values():
+        poller.log_stats()
+    for name, scheduler in _schedulers.items():
+        scheduler.log_stats(name)
+    if _last_seen is not None:
+        _last_seen.log_stats()
+
+
+def run(archive=ARCHIVE_SNAPSHOTS):
+    if archive:
+        archive_feeds(["vehicle_positions"])
+    poller = get_poller(VehiclePositionsUrl, parse_vehicle_positions)
+    scheduler = _schedulers["vehicle_positions"] = \
+        PollScheduler(POLL_INTERVAL)
     try:
         while True:
+            started = time.time()
             store_latest_updates()
-            time.sleep(15)
+            flush_writers()
+            scheduler.record(started, poller.timestamp, poller.failed)
+            if scheduler.stats["polls"] % STATS_INTERVAL == 0:
+                log_poller_stats()
+            time.sleep(scheduler.delay())
     except KeyboardInterrupt:
+        log_poller_stats()
         print("Exiting")
     except Exception as err:
         pass
+    finally:
+        # Saving the vehicles seen after a failed close would skip the
+        # unwritten reports when the recorder restarts
+        if close_writers():
+            save_last_seen()
+        close_archives()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Record the MBTA's realtime feeds")
+    parser.add_argument("--feeds", nargs="+", choices=list(FEEDS),
+                        help=("Record these feeds concurrently, instead of "
+                              "only polling vehicle positions"))
+    parser.add_argument("--archive", action="store_true",
+                        default=ARCHIVE_SNAPSHOTS,
+                        help=("Also archive the raw messages under "
+                              "snapshots/ (see replay.py)"))
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    # Stop on SIGTERM (from systemd or docker stop, say) as on Ctrl-C, so
+    # that buffered rows are written out before exiting
+    signal.signal(signal.SIGTERM, _interrupt)
+    if args.feeds:
+        run_feeds(args.feeds, archive=args.archive)
+    else:
+        run(archive=args.archive)
 
 
 if __name__ == "__main__":
-    run()
+    main()
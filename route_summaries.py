@@ -1,16 +1,26 @@
+from collections import namedtuple
 from datetime import datetime, time
+from functools import partial
 import glob
+import multiprocessing.pool as mp
 import os
 import re
 import sys
 
+import numpy as np
 import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+from summarize import DELAY_BIN_SECONDS
+
+
+TZ = "US/Eastern"
 
 
 def combine_summaries(file_pairs):
     return pd.concat([
         dframe.assign(trip_start=re.match(r"(\d{4}-\d{2}-\d{2})",
-                                          os.path.basename(filepath)))
+                                          os.path.basename(filepath)).group(1))
         for filepath, dframe in file_pairs
     ])
 
@@ -28,50 +38,286 @@ def summarize_route(route_df):
     })
 
 
-def date_parser(dts):
-    return pd.to_datetime(dts.rpartition("-")[0])
+# Columns of the route summary, with the column of the trip summaries and
+# the aggregation used to compute each
+ROUTE_AGGREGATIONS = [
+    ("trip_count", "trip_id", "nunique"),
+    ("count", "trip_id", "count"),
+    ("total_stops_recorded", "recorded_stops", "sum"),
+    ("median_start_delay", "first_delay", "median"),
+    ("mean_start_delay", "first_delay", "mean"),
+    ("median_end_delay", "last_delay", "median"),
+    ("mean_end_delay", "last_delay", "mean"),
+    ("mean_median_delay", "delay_50", "mean"),
+]
+
+
+def summarize_routes(df, keys=["route_id"]):
+    """Computes the same result as applying `summarize_route` to each route
+    in `df`, with a single aggregation over all routes. Pass `keys` to
+    group by other columns as well."""
+    aggregations = {}
+    for _, column, agg in ROUTE_AGGREGATIONS:
+        aggregations.setdefault(column, []).append(agg)
+    summary = df.groupby(keys, observed=True).agg(aggregations)
+    return pd.DataFrame({name: summary[(column, agg)]
+                         for name, column, agg in ROUTE_AGGREGATIONS},
+                        columns=[name for name, _, _ in ROUTE_AGGREGATIONS])\
+             .astype("float64")
+
+
+def parse_local_times(timestamps):
+    """Convert a Series of timestamp strings with UTC offsets to naive local
+    times."""
+    return pd.to_datetime(timestamps, utc=True).dt.tz_convert(TZ)\
+             .dt.tz_localize(None)
+
+
+SUMMARY_COLUMNS = ["trip_id", "route_id", "recorded_stops", "first_delay",
+                   "last_delay", "delay_50", "scheduled_start", "scheduled_end"]
+
+
+def read_summary(filepath, routes=None):
+    """Read the columns of a trip summary file needed for route summaries. If
+    `routes` is given, only trips on those routes are kept."""
+    if filepath.endswith(".parquet"):
+        return read_summary_parquet(filepath, routes)
+    df = read_summary_csv(filepath)
+    return df[df.route_id.isin(routes)] if routes else df
 
 
-def read_summary(filepath):
+def read_summary_parquet(filepath, routes=None):
+    """Read a summary written with the Parquet schema from `typed_summary`.
+    Only the needed columns are read, and with `routes`, row groups for other
+    routes are skipped."""
+    filters = [("route_id", "in", list(routes))] if routes else None
+    df = pd.read_parquet(filepath, columns=SUMMARY_COLUMNS, filters=filters)\
+           .dropna(subset=["first_delay"])
+    # Match read_summary_csv, which gives local times without a timezone
+    # and strings rather than categories (whose order would otherwise
+    # carry through to the route summaries)
+    for column in ["scheduled_start", "scheduled_end"]:
+        df[column] = df[column].dt.tz_localize(None)
+    for column in df.select_dtypes("category"):
+        df[column] = df[column].astype(object)
+    return df
+
+
+def read_summary_csv(filepath):
     df = pd.read_csv(filepath,
-                     dtype="unicode",
-                     usecols=["trip_id", "route_id",
-                              "recorded_stops", "first_delay", "last_delay",
-                              "delay_50", "scheduled_start", "scheduled_end"],
-                     parse_dates=["scheduled_start", "scheduled_end"],
-                     date_parser=date_parser)\
+                     usecols=SUMMARY_COLUMNS,
+                     dtype={"trip_id": str, "route_id": str,
+                            "scheduled_start": str, "scheduled_end": str})\
            .dropna(subset=["first_delay"])
-    return df.assign(first_delay=pd.to_numeric(df.first_delay),
-                     last_delay=pd.to_numeric(df.last_delay),
-                     recorded_stops=pd.to_numeric(df.recorded_stops),
-                     delay_50=pd.to_numeric(df.delay_50))
+    return df.assign(scheduled_start=parse_local_times(df.scheduled_start),
+                     scheduled_end=parse_local_times(df.scheduled_end))
+
+
+def _read_filtered(filepath, filter_fn=None, routes=None):
+    df = read_summary(filepath, routes)
+    return filter_fn(df) if filter_fn else df
+
 
+def read_summaries(paths, filter_fn=None, routes=None, processes=None):
+    """Returns a list of (path, summary) pairs for the trip summaries in
+    `paths`, reading them with a process pool. `filter_fn`, if given, is
+    applied to each summary in the worker and must be picklable (that is,
+    not a lambda)."""
+    paths = list(paths)
+    read = partial(_read_filtered, filter_fn=filter_fn, routes=routes)
+    if processes == 1 or len(paths) < 2:
+        return list(zip(paths, map(read, paths)))
+    with mp.Pool(processes) as pool:
+        return list(zip(paths, pool.map(read, paths)))
 
-def summarize_route_files(paths, filter_fn=lambda x: x):
+
+def summarize_route_files(paths, filter_fn=None, routes=None, processes=None,
+                          windows=None, holidays=None):
+    """Summarize the routes in the trip summaries at `paths`. If `windows` (a
+    list of Windows) is given, the result has a row for each window and
+    route, computed in a single pass, instead of a row for each route."""
+    if windows:
+        paths = [path for path in paths if in_date_ranges(path, windows)]
     combined = combine_summaries(
-        (path, filter_fn(read_summary(path)))
-        for path in paths
-    )
-    return combined.groupby("route_id").apply(summarize_route)
+        read_summaries(paths, filter_fn, routes, processes))
+    if not windows:
+        return summarize_routes(combined)
 
+    rows, window_indexes = np.nonzero(
+        window_memberships(combined, windows, holidays))
+    names = np.array([window.name for window in windows], dtype=object)
+    tagged = combined.iloc[rows].assign(window=names[window_indexes])
+    return summarize_routes(tagged, keys=["window", "route_id"])
 
-def rush_hour_filter(df):
-    rh_morning_start_range = (time(7), time(8, 30))
-    rh_morning_end_range = (time(8), time(9))
 
-    rh_evening_start_range = (time(16), time(17, 30))
-    rh_evening_end_range = (time(17), time(18, 30))
+def read_aggregates(filepath, hours=None, routes=None):
+    """Read route aggregates written by summarize.route_aggregates, keeping
+    only the given `hours` of scheduled start and `routes`, if any."""
+    df = pd.read_csv(filepath, dtype={"route_id": str, "stat": str})
+    if hours is not None:
+        df = df[df.hour.isin(hours)]
+    if routes is not None:
+        df = df[df.route_id.isin(routes)]
+    return df
+
+
+def merge_aggregates(frames, keys=["route_id", "hour"]):
+    """Combine route aggregates from several files, or from several hours
+    when `keys` does not include "hour", by summing their values."""
+    return pd.concat(frames, ignore_index=True)\
+             .groupby(keys + ["stat", "bin"])["value"].sum()\
+             .reset_index()
+
 
-    start = df.scheduled_start.dt.time
-    end = df.scheduled_end.dt.time
+def histogram_median(hist, keys):
+    """Estimate the median of each group of histogram rows (with columns
+    bin and value) by interpolating within the bin where the cumulative
+    count passes half the total. The estimate is within DELAY_BIN_SECONDS
+    of the lower median if that lies in summarize.DELAY_BIN_RANGE."""
+    hist = hist.sort_values(keys + ["bin"])
+    groups = hist.groupby(keys)["value"]
+    hist = hist.assign(before=groups.cumsum() - hist.value,
+                       half=groups.transform("sum") / 2)
+    crossing = hist[(hist.before < hist.half) &
+                    (hist.before + hist.value >= hist.half)]\
+        .drop_duplicates(keys).set_index(keys)
+    return (crossing.bin + (crossing.half - crossing.before) / crossing.value) \
+        * DELAY_BIN_SECONDS
 
-    return df[start.between(*rh_morning_start_range) |
-              end.between(*rh_morning_start_range) |
-              start.between(*rh_evening_start_range) |
-              end.between(*rh_evening_end_range)]
+
+def summarize_route_aggregates(paths, hours=None, routes=None):
+    """Summarize routes from the aggregate files in `paths`, without reading
+    any trip summaries. The result has the columns of `summarize_routes`
+    except trip_count, since distinct trip ids cannot be counted from
+    partial counts. Medians are estimated from histograms (see
+    `histogram_median`)."""
+    merged = merge_aggregates([read_aggregates(path, hours, routes)
+                               for path in paths],
+                              keys=["route_id"])
+    scalars = merged[~merged.stat.str.endswith("_hist")]\
+        .pivot(index="route_id", columns="stat", values="value")\
+        .reindex(columns=["count", "total_stops_recorded"] +
+                 [column + suffix
+                  for column in ["first_delay", "last_delay", "delay_50"]
+                  for suffix in ["_count", "_sum"]])
+    hist = merged[merged.stat.str.endswith("_hist")]
+
+    def median(column):
+        return histogram_median(hist[hist.stat == column + "_hist"],
+                                ["route_id"]).reindex(scalars.index)
+
+    def mean(column):
+        return scalars[column + "_sum"] / scalars[column + "_count"]
+
+    return pd.DataFrame({
+        "count": scalars["count"],
+        "total_stops_recorded": scalars["total_stops_recorded"],
+        "median_start_delay": median("first_delay"),
+        "mean_start_delay": mean("first_delay"),
+        "median_end_delay": median("last_delay"),
+        "mean_end_delay": mean("last_delay"),
+        "mean_median_delay": mean("delay_50"),
+    }, columns=["count", "total_stops_recorded", "median_start_delay",
+                "mean_start_delay", "median_end_delay", "mean_end_delay",
+                "mean_median_delay"]).astype("float64")
+
+
+# A named time window. A trip is in the window if its scheduled start time
+# is within start_range or its scheduled end time is within end_range (each
+# an inclusive (time, time) pair, or None). A window with neither range
+# covers the whole day. If service_types is given, the trip's date must
+# have one of those service types (see `service_types`), and if date_range
+# is given, the date must be within that inclusive (date, date) range.
+Window = namedtuple("Window", ["name", "start_range", "end_range",
+                               "service_types", "date_range"])
+Window.__new__.__defaults__ = (None, None, None, None)
+
+RUSH_HOUR_WINDOWS = [
+    # The end range matches the start range, as it always has in
+    # rush_hour_filter.
+    Window("morning_rush", start_range=(time(7), time(8, 30)),
+           end_range=(time(7), time(8, 30))),
+    Window("evening_rush", start_range=(time(16), time(17, 30)),
+           end_range=(time(17), time(18, 30))),
+]
+
+
+def _seconds(t):
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def seconds_since_midnight(timestamps):
+    """Returns an int64 array with the local clock time of each naive
+    timestamp in seconds after midnight, and -1 for missing values."""
+    values = timestamps.values
+    seconds = (values - values.astype("datetime64[D]"))\
+        .astype("timedelta64[s]").astype(np.int64)
+    return np.where(pd.isnull(values), -1, seconds)
+
+
+def service_types(dates, holidays=None):
+    """Returns an array with the service type ("weekday", "weekend" or
+    "holiday") of each date. `holidays` defaults to US federal holidays."""
+    dates = pd.DatetimeIndex(pd.to_datetime(dates)).normalize()
+    if holidays is None:
+        holidays = USFederalHolidayCalendar().holidays(dates.min(), dates.max())
+    types = np.where(dates.dayofweek >= 5, "weekend", "weekday").astype(object)
+    types[dates.isin(pd.to_datetime(list(holidays)))] = "holiday"
+    return types
+
+
+def in_date_ranges(filepath, windows):
+    """Returns True if the summary at `filepath` could have trips in any of
+    `windows`, judging by the date in its file name."""
+    if any(window.date_range is None for window in windows):
+        return True
+    m = re.match(r"(\d{4}-\d{2}-\d{2})", os.path.basename(filepath))
+    day = datetime.strptime(m.group(1), "%Y-%m-%d").date()
+    return any(first <= day <= last for first, last in
+               (window.date_range for window in windows))
+
+
+def window_memberships(df, windows, holidays=None):
+    """Returns a boolean array with a row for each trip in `df` and a column
+    for each of `windows`, indicating whether the trip is in that window.
+    Times are compared as integer seconds since midnight, and each column
+    of `df` is converted only once. `df` needs a trip_start date column
+    (as added by `combine_summaries`) if any window has service types or a
+    date range."""
+    start = seconds_since_midnight(df.scheduled_start)
+    end = seconds_since_midnight(df.scheduled_end)
+    dates = types = None
+    if any(window.service_types or window.date_range for window in windows):
+        dates = pd.to_datetime(df.trip_start).values
+        types = service_types(dates, holidays)
+
+    def between(seconds, time_range):
+        low, high = map(_seconds, time_range)
+        return (seconds >= low) & (seconds <= high)
+
+    memberships = np.zeros((len(df), len(windows)), dtype=bool)
+    for i, window in enumerate(windows):
+        if not window.start_range and not window.end_range:
+            # Any time of day
+            memberships[:, i] = True
+        if window.start_range:
+            memberships[:, i] |= between(start, window.start_range)
+        if window.end_range:
+            memberships[:, i] |= between(end, window.end_range)
+        if window.service_types:
+            memberships[:, i] &= np.isin(types, list(window.service_types))
+        if window.date_range:
+            first, last = (np.datetime64(d, "ns") for d in window.date_range)
+            memberships[:, i] &= (dates >= first) & (dates <= last)
+    return memberships
+
+
+def rush_hour_filter(df):
+    return df[window_memberships(df, RUSH_HOUR_WINDOWS).any(axis=1)]
 
 
 if __name__ == "__main__":
-    summarize_route_files(glob.glob("summary/*.csv.gz"),
+    summarize_route_files(glob.glob("summary/*.csv.gz") +
+                          glob.glob("summary/*.parquet"),
                           rush_hour_filter)\
         .to_csv(sys.stdout)
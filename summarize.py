@@ -1,23 +1,45 @@
-# Requirements: pandas and pytz
+# Requirements: pandas and pytz (and pyarrow for Parquet output)
 
 # When run directly, the script expects to be in a directory containing
-# descendant files of the form YYYY/mm/YYYY-mm-dd.csv.gz. It will use a
+# descendant files of the form YYYY/mm/YYYY-mm-dd.csv.gz (or
+# YYYY/mm/YYYY-mm-dd.obs[.gz], see observations.py). It will use a
 # multiprocessing pool to process each file it finds and generate outputs in
-# the 'summary' subdirectory. It will also download MBTA feeds to the 'feeds'
-# subdirectory as needed. To prevent file corruption, only one feed is
-# downloaded at a time. This comes at the cost of some parallelism, but not
-# enough to matter much.
+# the 'summary' subdirectory, skipping files whose summaries are already up
+# to date (see --help for overrides). It will also download MBTA feeds to the
+# 'feeds' subdirectory (or $MBTA_FEED_DIR) as needed and keep them for later
+# runs. To prevent file corruption, each feed is downloaded by only one
+# process at a time, under a lock file next to the archive. The trips and
+# stop_times tables of each feed are parsed once and cached as
+# memory-mappable .npy files under FEED_CACHE_DIR.
+#
+# The time, output rows and memory use of each stage of processing a file
+# are logged as JSON lines (see StageMetrics). With --metrics (or
+# $MBTA_WRITE_METRICS), they are also written next to each summary, and
+# with --profile DIR (or $MBTA_PROFILE_DIR), each file is run under
+# cProfile and its profile written to DIR.
 
+import argparse
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+import cProfile
 import csv
 from datetime import datetime, timedelta
+import fcntl
+import gzip
+from functools import partial
 from io import BytesIO, TextIOWrapper
+import json
 import logging
-from multiprocessing import Lock
+import math
 import multiprocessing.pool as mp
 import os
 import re
+import resource
+import shutil
 import tempfile
-from urllib.error import HTTPError
+import time
+from urllib.error import HTTPError, URLError
 from urllib.request import urlopen, urlretrieve
 
 import numpy as np
@@ -25,31 +47,112 @@ import pandas as pd
 import pytz
 import zipfile
 
+import observations
+
 
 CURRENT_FEED_URL = "http://www.mbta.com/uploadedfiles/MBTA_GTFS.zip"
 FEED_URLS = "https://www.mbta.com/gtfs_archive/archived_feeds.txt"
-FEED_DIR = tempfile.mkdtemp(prefix="feeds")
+try:
+    DEFAULT_FEED_DIR = os.path.join(os.path.dirname(__file__), "feeds")
+except NameError as _:
+    DEFAULT_FEED_DIR = os.path.join(os.getcwd(), "feeds")
+
+FEED_DIR = os.environ.get("MBTA_FEED_DIR", DEFAULT_FEED_DIR)
+# Once the archives in FEED_DIR, with their lock files and parsed tables,
+# take up more than this, the least recently used ones are deleted.
+FEED_DIR_MAX_BYTES = int(os.environ.get("MBTA_FEED_DIR_MAX_MB", 2048)) * 2**20
+# Parsed tables from each feed archive are cached here. Set to an empty
+# string to disable the cache.
+FEED_CACHE_DIR = os.environ.get("MBTA_FEED_CACHE_DIR",
+                                os.path.join(FEED_DIR, "parsed"))
+# Bump this whenever the cached columns or their types change.
+FEED_CACHE_VERSION = 3
+# Bump this whenever the summary output changes, so that process_all will
+# regenerate existing summaries.
+SUMMARY_VERSION = 1
+# The number of rows read at a time when summarizing a file in partitions
+STREAM_CHUNKSIZE = 200000
+# When summarizing a file in partitions, there are enough of them to keep
+# each to about this many rows, whatever the size of the day
+PARTITION_ROWS = int(os.environ.get("MBTA_PARTITION_ROWS", 500000))
 TZ = pytz.timezone("US/Eastern")
+# The feed list is downloaded again once the local copy is this old
+FEED_URLS_TTL = int(os.environ.get("MBTA_FEED_URLS_TTL_HOURS", 24)) * 3600
 _feed_urls = None
+_feed_index = None
+# Maps the cache key of a single feed to its parsed tables
+_feed_tables = {}
+# Set to write the stage metrics of each summary (see StageMetrics) to a
+# .metrics.json file next to it
+WRITE_METRICS = os.environ.get("MBTA_WRITE_METRICS", "") not in ("", "0")
+# Set to a directory to write a cProfile profile of each file processed to
+PROFILE_DIR = os.environ.get("MBTA_PROFILE_DIR") or None
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+def fetch_feed_urls():
+    """Returns the path to a local copy of the MBTA's list of archived feeds,
+    downloading it if the copy is missing or older than FEED_URLS_TTL. When
+    the list cannot be downloaded, a stale copy is used if there is one.
+    """
+    path = os.path.join(FEED_DIR, "archived_feeds.txt")
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        age = None
+
+    if age is None or age > FEED_URLS_TTL:
+        try:
+            with urlopen(FEED_URLS) as u:
+                data = u.read()
+            os.makedirs(FEED_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=FEED_DIR)
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(data)
+            os.replace(tmp_path, path)
+        except URLError as err:
+            if age is None:
+                raise
+            logger.warning("Could not refresh the feed list (%s); "
+                           "using the copy from %d hours ago", err, age // 3600)
+    return path
+
+
 def get_feed_urls():
     global _feed_urls
     if not _feed_urls:
-        with urlopen(FEED_URLS) as u:
-            _feed_urls = list(csv.DictReader(TextIOWrapper(BytesIO(u.read()))))
+        with open(fetch_feed_urls(), encoding="utf-8") as infile:
+            _feed_urls = list(csv.DictReader(infile))
     return _feed_urls
 
 def mbta_feed_urls():
     """Returns a generator of (feed_start_date, feed_end_date, archive_url)
     tuples from the MBTA's archived feeds site.
     """
-    for l in get_feed_urls():
-        yield (datetime.strptime(l["feed_start_date"], "%Y%m%d"),
-               datetime.strptime(l["feed_end_date"], "%Y%m%d"),
-               l["archive_url"])
+    return iter(get_feed_index().rows)
+
+
+FeedIndex = namedtuple("FeedIndex", ["rows", "starts", "ends", "urls"])
+
+
+def get_feed_index():
+    """Returns the archived feed list, parsed once, with the start dates,
+    end dates and urls of the feeds sorted by start date for bisection.
+    """
+    global _feed_index
+    if not _feed_index:
+        rows = [(datetime.strptime(l["feed_start_date"], "%Y%m%d"),
+                 datetime.strptime(l["feed_end_date"], "%Y%m%d"),
+                 l["archive_url"])
+                for l in get_feed_urls()]
+        # When two feeds start on the same day, prefer the one listed first.
+        order = sorted(range(len(rows)), key=lambda i: (rows[i][0], -i))
+        _feed_index = FeedIndex(rows=rows,
+                                starts=[rows[i][0] for i in order],
+                                ends=[rows[i][1] for i in order],
+                                urls=[rows[i][2] for i in order])
+    return _feed_index
 
 
 def current_feed_start():
@@ -57,14 +160,17 @@ def current_feed_start():
     return end
 
 
+def _as_eastern(when):
+    """Feed dates are naive dates in Eastern time."""
+    if when.tzinfo:
+        return when.astimezone(TZ).replace(tzinfo=None)
+    return when
+
+
 def mbta_feed_urls_for(range_start=None, range_end=None):
-    eastern = pytz.timezone("US/Eastern")
-    range_start = range_start or datetime.now()
-    range_end = range_end or range_start
+    range_start = _as_eastern(range_start or datetime.now())
+    range_end = _as_eastern(range_end) if range_end else range_start
     for start, end, url in mbta_feed_urls():
-        if range_start.tzinfo:
-            start = start.astimezone(eastern)
-            end = end.astimezone(eastern)
         if start <= range_end:
             if range_start >= end:
                 yield
@@ -76,68 +182,533 @@ def mbta_feed_urls_for(range_start=None, range_end=None):
 def mbta_feed_url_for(when):
     """Get the URL for the MBTA's GTFS feed active at the 
     datetime `when`."""
-    return next(mbta_feed_urls_for(when, when), None)
+    return mbta_feed_urls_for_dates([when])[0]
+
+
+def mbta_feed_urls_for_dates(dates):
+    """Returns a list with the URL of the archived feed active at each
+    datetime in `dates`, or None where the current feed should be used.
+    """
+    index = get_feed_index()
+    urls = []
+    for when in dates:
+        when = _as_eastern(when)
+        # The latest feed to start on or before `when`
+        i = bisect_right(index.starts, when) - 1
+        urls.append(None if i < 0 or when >= index.ends[i] else index.urls[i])
+    return urls
+
+
+def download_zip(url, local_zip):
+    """Download the zip archive at `url` to `local_zip`. The archive is
+    written to a temporary file, which is checked and then renamed, so
+    `local_zip` is never left incomplete or corrupt.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".part",
+                                    dir=os.path.dirname(local_zip))
+    os.close(fd)
+    try:
+        # Raises ContentTooShortError if the size does not match the
+        # Content-Length header.
+        urlretrieve(url, tmp_path)
+        with zipfile.ZipFile(tmp_path) as z:
+            bad_member = z.testzip()
+        if bad_member:
+            raise zipfile.BadZipFile(
+                f"Bad CRC for {bad_member} in archive downloaded from {url}")
+        os.replace(tmp_path, local_zip)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _disk_usage(path):
+    """Returns the size of the file at `path`, or of all the files under it
+    if it is a directory."""
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+    return sum(_disk_usage(os.path.join(d, name))
+               for d, _, files in os.walk(path) for name in files)
+
+
+def _lock_feed(local_zip, operation):
+    """Returns the lock file of the archive `local_zip`, open and locked with
+    the flock `operation`. Raises BlockingIOError if `operation` includes
+    LOCK_NB and the lock is held elsewhere."""
+    path = local_zip + ".lock"
+    while True:
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, operation)
+            # evict_feeds removes lock files while holding them, so a lock on
+            # a file that has since been removed protects nothing
+            st = os.stat(path)
+            open_st = os.fstat(lock_file.fileno())
+            if (st.st_dev, st.st_ino) == (open_st.st_dev, open_st.st_ino):
+                return lock_file
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            lock_file.close()
+            raise
+        lock_file.close()
+
+
+def evict_feeds(max_bytes=None, keep=None):
+    """Delete the least recently used archives in FEED_DIR, with their lock
+    files and parsed tables, until all of them together use no more than
+    `max_bytes`. Parsed tables whose archive is gone are deleted first. The
+    archive at the path `keep` is never deleted, and neither is one whose
+    lock is held by another process, which is using or downloading it.
+    """
+    max_bytes = FEED_DIR_MAX_BYTES if max_bytes is None else max_bytes
+    # Maps the name of each archive (without .zip) to its last use, the
+    # paths of its files and their total size
+    feeds = defaultdict(lambda: {"mtime": 0, "paths": [], "size": 0})
+    for name in os.listdir(FEED_DIR):
+        if name.endswith(".zip") or name.endswith(".zip.lock"):
+            feed = feeds[name[:name.rindex(".zip")]]
+            feed["paths"].append(os.path.join(FEED_DIR, name))
+    if FEED_CACHE_DIR and os.path.isdir(FEED_CACHE_DIR):
+        for key in os.listdir(FEED_CACHE_DIR):
+            m = re.match(r"(.+)-v\d+-[0-9a-f]+$", key)
+            if m:
+                feeds[m.group(1)]["paths"].append(
+                    os.path.join(FEED_CACHE_DIR, key))
+    for name, feed in feeds.items():
+        feed["size"] = sum(map(_disk_usage, feed["paths"]))
+        try:
+            feed["mtime"] = os.stat(os.path.join(FEED_DIR,
+                                                 name + ".zip")).st_mtime
+        except FileNotFoundError:
+            pass
+
+    total = sum(feed["size"] for feed in feeds.values())
+    for name, feed in sorted(feeds.items(), key=lambda item: item[1]["mtime"]):
+        if total <= max_bytes:
+            break
+        path = os.path.join(FEED_DIR, name + ".zip")
+        if keep and path == keep:
+            continue
+        try:
+            lock_file = _lock_feed(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            continue
+        with lock_file:
+            if feed["mtime"]:
+                logger.info("Evicting feed archive %s", path)
+            for feed_path in feed["paths"] + [path + ".lock"]:
+                if os.path.isdir(feed_path):
+                    shutil.rmtree(feed_path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(feed_path)
+                    except FileNotFoundError:
+                        pass
+        total -= feed["size"]
+
+
+def _is_local_zip(path):
+    return os.path.exists(path) and zipfile.is_zipfile(path)
 
 
 def get_zip(url=CURRENT_FEED_URL, local_basename=None):
     local_zip = os.path.join(FEED_DIR, local_basename or os.path.basename(url))
-    if not os.path.exists(local_zip):
-        os.makedirs(FEED_DIR, exist_ok=True)
-        urlretrieve(url, local_zip)
-    return zipfile.ZipFile(open(local_zip, "rb"))
+    os.makedirs(FEED_DIR, exist_ok=True)
+    # Only one process downloads a given archive. Others that want the same
+    # archive wait for it, while downloads of different archives proceed in
+    # parallel. An existing archive is opened under a shared lock, so that
+    # evict_feeds leaves it alone in the meantime; once open, it can be
+    # removed.
+    while True:
+        exists = _is_local_zip(local_zip)
+        with _lock_feed(local_zip,
+                        fcntl.LOCK_SH if exists else fcntl.LOCK_EX):
+            if _is_local_zip(local_zip):
+                # The modification time is used to find the least recently
+                # used archives when evicting.
+                os.utime(local_zip)
+                return zipfile.ZipFile(open(local_zip, "rb"))
+            if not exists:
+                download_zip(url, local_zip)
+                evict_feeds(keep=local_zip)
+                return zipfile.ZipFile(open(local_zip, "rb"))
+        # The archive was evicted before it could be locked, so take the
+        # lock again to download it
+
+
+def mbta_feed_location(when):
+    """Returns the (url, local_basename) arguments to `get_zip` for the feed
+    active at the datetime `when`."""
+    return mbta_feed_locations([when])[0]
+
+
+def mbta_feed_locations(dates):
+    current = None
+    locations = []
+    for url in mbta_feed_urls_for_dates(dates):
+        if url:
+            locations.append((url, None))
+        else:
+            current = current or (CURRENT_FEED_URL,
+                                  current_feed_start().strftime("%Y%m%d.zip"))
+            locations.append(current)
+    return locations
 
 
 def mbta_feed_for(when):
-    url = mbta_feed_url_for(when)
-    basename = None if url else current_feed_start().strftime("%Y%m%d.zip")
-    return get_zip(url or CURRENT_FEED_URL, basename)
+    return get_zip(*mbta_feed_location(when))
 
 
-def get_zip_item(feed, name, dtype="unicode"):
+def get_zip_item(feed, name, dtype="unicode", usecols=None):
     data = TextIOWrapper(BytesIO(feed.read(name + ".txt")), 
                          encoding="utf-8", line_buffering=True)
-    return pd.read_csv(data, dtype=dtype)
+    return pd.read_csv(data, dtype=dtype, usecols=usecols)
+
+
+def feed_cache_key(feed):
+    """Returns a key identifying the contents of an open feed archive, or None
+    if the archive has no file name. The key combines the archive's name with
+    the CRCs of the tables that are cached, so a re-downloaded feed with
+    different contents gets a new cache entry.
+    """
+    if not feed.filename:
+        return None
+    name = os.path.splitext(os.path.basename(feed.filename))[0]
+    crcs = (feed.getinfo(table + ".txt").CRC for table in sorted(FEED_TABLES))
+    return "{}-v{}-{}".format(name, FEED_CACHE_VERSION,
+                              "".join("{:08x}".format(crc) for crc in crcs))
+
+
+def _write_table(df, path):
+    """Write each column of `df` to a .npy file in the directory `path`.
+    Categorical columns are stored as their codes and categories so that the
+    codes can be memory mapped."""
+    os.makedirs(path)
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.name == "category":
+            np.save(os.path.join(path, column + ".codes.npy"),
+                    values.cat.codes.values)
+            np.save(os.path.join(path, column + ".categories.npy"),
+                    values.cat.categories.values.astype(str))
+        else:
+            np.save(os.path.join(path, column + ".npy"), values.values)
+
+
+def _read_table(path, columns):
+    data = {}
+    for column in columns:
+        codes_path = os.path.join(path, column + ".codes.npy")
+        if os.path.exists(codes_path):
+            data[column] = pd.Categorical.from_codes(
+                np.load(codes_path, mmap_mode="r"),
+                np.load(os.path.join(path, column + ".categories.npy")))
+        else:
+            data[column] = np.load(os.path.join(path, column + ".npy"),
+                                   mmap_mode="r")
+    return pd.DataFrame(data, columns=columns)
+
+
+def get_feed_table(feed, name, cache_dir=None):
+    """Returns the parsed table `name` (one of the keys of FEED_TABLES) from the
+    feed archive `feed`. Parsed tables are stored in `cache_dir` (by default,
+    FEED_CACHE_DIR) and memory mapped on later calls, so a feed shared by
+    many days is only parsed once. The tables of the most recently used feed
+    are also kept in memory.
+    """
+    global _feed_tables
+    key = feed_cache_key(feed)
+    if key is None:
+        return _load_feed_table(feed, name, cache_dir)
+    if key not in _feed_tables:
+        _feed_tables = {key: {}}
+    tables = _feed_tables[key]
+    if name not in tables:
+        tables[name] = _load_feed_table(feed, name, cache_dir)
+    return tables[name]
+
+
+def _load_feed_table(feed, name, cache_dir):
+    parse, columns = FEED_TABLES[name]
+    cache_dir = FEED_CACHE_DIR if cache_dir is None else cache_dir
+    key = cache_dir and feed_cache_key(feed)
+    if not key:
+        return parse(feed)
+
+    path = os.path.join(cache_dir, key, name)
+    if os.path.exists(path):
+        try:
+            return _read_table(path, columns)
+        except FileNotFoundError:
+            # Evicted (see evict_feeds) since it was found
+            pass
+    df = parse(feed)
+    # Write to a temporary directory first so that other processes never see
+    # a partially written table.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=name, dir=os.path.dirname(path))
+    try:
+        _write_table(df, os.path.join(tmp_path, name))
+        os.rename(os.path.join(tmp_path, name), path)
+    except OSError:
+        # Another process got there first.
+        if not os.path.exists(path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return df
 
 
 DIR_PATTERN = "%Y/%m"
 FILE_PATTERN = "%Y-%m-%d.csv.gz"
 
 def date_from_filepath(filepath):
-    return datetime.strptime(os.path.basename(filepath), FILE_PATTERN)
+    # Daily files are named for their date, whatever their format
+    return datetime.strptime(os.path.basename(filepath)[:10], "%Y-%m-%d")
 
 def filepath_from_date(dt):
     return dt.strftime(os.path.join(DIR_PATTERN, FILE_PATTERN))
 
 
-def get_df(filepath):
-    dt = date_from_filepath(filepath)
-    kwargs = {}
-    if dt <= datetime(2017, 8, 1):
-        kwargs = {"names": ["trip_id", "trip_start", "stop_id", 
-                            "stop_sequence", "vehicle_id", "status", 
-                            "timestamp", "lat", "lon"]}
-    df = pd.read_csv(filepath,
-                     dtype="unicode",
+# The columns of the daily files. Files from before 2017-08-01 have no header.
+RAW_COLUMNS = ["trip_id", "trip_start", "stop_id", "stop_sequence",
+               "vehicle_id", "status", "timestamp", "lat", "lon"]
+# The columns that get_df reads by default, and the types to read them as
+DF_DTYPES = {"trip_id": "category",
+             "stop_id": "category",
+             "stop_sequence": "float64",
+             "status": "category",
+             "timestamp": "unicode"}
+
+
+def _headerless_kwargs(filepath):
+    if date_from_filepath(filepath) <= datetime(2017, 8, 1):
+        return {"names": RAW_COLUMNS}
+    return {}
+
+
+def get_df(filepath, columns=None):
+    """Read the observations in the daily file `filepath`, a CSV file or an
+    observation file (see observations.py). Only `columns` (by default, the
+    keys of DF_DTYPES) are read.
+    """
+    if observations.is_observation_file(filepath):
+        return read_observation_file(filepath, columns)
+    return read_observations(filepath, columns, **_headerless_kwargs(filepath))
+
+
+def read_observation_file(filepath, columns=None):
+    """Read an observation file into the same frame that read_observations
+    makes of the equivalent CSV file."""
+    columns = columns or list(DF_DTYPES)
+    df = observations.read_file(filepath)[columns]
+    if "stop_sequence" in df:
+        df["stop_sequence"] = pd.to_numeric(df["stop_sequence"],
+                                            downcast="integer")
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", utc=True)\
+                        .dt.tz_convert(TZ)
+    df.drop_duplicates(subset=["trip_id", "timestamp"], inplace=True)
+    return df
+
+
+def read_observations(source, columns=None, **kwargs):
+    """Read observations from `source`, a path or buffer in the format of the
+    daily files. Extra keyword arguments are passed to `pd.read_csv`.
+    """
+    columns = columns or list(DF_DTYPES)
+    df = pd.read_csv(source,
+                     usecols=columns,
+                     dtype={c: DF_DTYPES.get(c, "unicode") for c in columns},
                      **kwargs)
+    if "stop_sequence" in df:
+        # Stays a float if there are missing values
+        df["stop_sequence"] = pd.to_numeric(df["stop_sequence"],
+                                            downcast="integer")
+    # This turns out to be faster than using a converter. Deduplicating after
+    # parsing compares int64 values rather than strings.
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True).dt.tz_convert(TZ)
     df.drop_duplicates(subset=["trip_id", "timestamp"], inplace=True)
-    # This turns out to be faster than using a converter
-    df["timestamp"] = pd.to_datetime(df["timestamp"]).dt.tz_localize("UTC").dt.tz_convert(TZ)
     return df
 
 
+def partition_file(filepath, outdir, partitions, chunksize=None):
+    """Read the daily file `filepath` `chunksize` rows at a time and append
+    each row to one of `partitions` CSV files in `outdir`, chosen by hashing
+    its trip_id. Every observation of a trip therefore ends up in the same
+    file, in its original order. Returns the paths of the files written.
+    """
+    columns = list(DF_DTYPES)
+    paths = [os.path.join(outdir, f"{i}.csv") for i in range(partitions)]
+    if observations.is_observation_file(filepath):
+        chunks = _observation_chunks(filepath, columns,
+                                     chunksize or STREAM_CHUNKSIZE)
+    else:
+        chunks = pd.read_csv(filepath, dtype="unicode", usecols=columns,
+                             chunksize=chunksize or STREAM_CHUNKSIZE,
+                             **_headerless_kwargs(filepath))
+    for chunk in chunks:
+        buckets = pd.util.hash_pandas_object(chunk["trip_id"], index=False)\
+                         .values % partitions
+        for bucket, rows in chunk.groupby(buckets):
+            path = paths[bucket]
+            rows.to_csv(path, mode="a", index=False, columns=columns,
+                        header=not os.path.exists(path))
+    return [path for path in paths if os.path.exists(path)]
+
+
+def _observation_chunks(filepath, columns, chunksize):
+    """Yields the observation file `filepath` about `chunksize` rows at a
+    time, as strings in the format of the CSV files."""
+    for df in observations.read_chunks(filepath, chunksize):
+        df = df[columns]
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")\
+                            .dt.strftime("%Y-%m-%d %H:%M:%S")
+        yield df
+
+
+def estimate_rows(filepath, sample_bytes=2**20):
+    """Estimate the number of observations in the local daily file
+    `filepath` from its size and, for a CSV file, the length of its first
+    lines. The size of a gzipped file is extrapolated from how well its
+    first `sample_bytes` compress. Returns None if `filepath` is not a local
+    file."""
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        return None
+    with open(filepath, "rb") as raw:
+        infile = raw
+        if filepath.endswith(".gz"):
+            infile = gzip.GzipFile(fileobj=raw)
+        sample = infile.read(sample_bytes)
+        if not sample:
+            return 0
+        if infile is not raw and raw.tell():
+            size = size * len(sample) / raw.tell()
+    if observations.is_observation_file(filepath):
+        return math.ceil(size / observations.ROW_DTYPE.itemsize)
+    return math.ceil(size * sample.count(b"\n") / len(sample))
+
+
+def get_trips(feed):
+    return get_zip_item(feed, "trips", dtype="category",
+                        usecols=FEED_TABLES["trips"][1])
+
+
 def add_route_info(df, feed):
-    trips = get_zip_item(feed, "trips")
-    return pd.merge(df, trips[["trip_id", "route_id", "direction_id"]],
+    trips = get_feed_table(feed, "trips")
+    # The summary is indexed by trip_id as well, which makes the merge key
+    # ambiguous.
+    return pd.merge(df.rename_axis(None),
+                    trips[["trip_id", "route_id", "direction_id"]],
                     on="trip_id", how="left")
 
 
+def get_stop_times(feed):
+    """Read the feed's stop times, parsing each arrival time into seconds
+    after the start of the service day. Rows are ordered by trip so that
+    each trip's stop times are contiguous (see `get_trip_offsets`)."""
+    stop_times = get_zip_item(feed, "stop_times",
+                              dtype={"trip_id": "category",
+                                     "stop_sequence": np.int32,
+                                     "arrival_time": "category"},
+                              usecols=["trip_id", "stop_sequence",
+                                       "arrival_time"])
+    order = np.argsort(stop_times["trip_id"].cat.codes.values, kind="mergesort")
+    stop_times = stop_times.take(order).reset_index(drop=True)
+    return stop_times.assign(
+        arrival_seconds=parse_clock_times(stop_times["arrival_time"]))
+
+
+# Maps the name of each cached feed table to the function that parses it and
+# the columns it has.
+FEED_TABLES = {
+    "trips": (get_trips, ["trip_id", "route_id", "direction_id"]),
+    "stop_times": (get_stop_times, ["trip_id", "stop_sequence",
+                                    "arrival_time", "arrival_seconds"]),
+}
+
+
+def get_trip_offsets(feed):
+    """Returns an array of offsets into the feed's stop_times table, such that
+    the stop times of the trip whose trip_id has category code i are in rows
+    offsets[i] up to offsets[i+1]."""
+    stop_times = get_feed_table(feed, "stop_times")
+    tables = _feed_tables.get(feed_cache_key(feed), {})
+    if "trip_offsets" not in tables:
+        trip_ids = stop_times["trip_id"].cat
+        tables["trip_offsets"] = np.searchsorted(
+            trip_ids.codes.values, np.arange(len(trip_ids.categories) + 1))
+    return tables["trip_offsets"]
+
+
+def get_stop_times_for(feed, trip_ids):
+    """Returns the rows of the feed's stop_times table for the trips in
+    `trip_ids`, found with the trip offsets instead of a scan of the whole
+    table."""
+    stop_times = get_feed_table(feed, "stop_times")
+    offsets = get_trip_offsets(feed)
+    codes = stop_times["trip_id"].cat.categories\
+                                 .get_indexer(np.asarray(trip_ids.dropna().unique()))
+    codes = np.sort(codes[codes >= 0])
+    starts = offsets[codes]
+    lengths = offsets[codes + 1] - starts
+    # For each trip, the range of rows from its start offset
+    rows = np.arange(lengths.sum()) + np.repeat(starts - (lengths.cumsum() - lengths),
+                                                lengths)
+    return stop_times.take(rows)
+
+
+def _schedule_key(trip_ids, stop_sequences, categories):
+    """Encode each (trip_id, stop_sequence) pair as a single int64, using the
+    trip_id's code in `categories`. Pairs with an unknown trip or a missing
+    stop sequence get -1."""
+    if trip_ids.dtype.name == "category":
+        codes = categories.get_indexer(trip_ids.cat.categories)
+        codes = np.where(trip_ids.cat.codes.values >= 0,
+                         codes[trip_ids.cat.codes.values], -1)
+    else:
+        codes = categories.get_indexer(trip_ids)
+    valid = (codes >= 0) & stop_sequences.notna().values
+    sequences = stop_sequences.fillna(0).values.astype(np.int64)
+    return np.where(valid, (codes.astype(np.int64) << 32) | sequences, -1)
+
+
 def add_schedule_times(stops, feed, outer=False):
-    stop_times = get_zip_item(feed, "stop_times", dtype="unicode")
+    """Add the scheduled arrival_time and arrival_seconds of each observation
+    in `stops`, joining only against the stop times of the trips in `stops`.
+    With `outer`, the result also has a row (with no observation) for each
+    scheduled stop of those trips that was not observed.
+    """
+    stop_times = get_stop_times_for(feed, stops["trip_id"])
+    categories = stop_times["trip_id"].cat.categories
+    scheduled = stop_times[["arrival_time", "arrival_seconds"]].assign(
+        schedule_key=_schedule_key(stop_times["trip_id"],
+                                   stop_times["stop_sequence"], categories))
+    if outer:
+        scheduled["scheduled_trip_id"] = stop_times["trip_id"].astype(object)
+        scheduled["scheduled_stop_sequence"] = stop_times["stop_sequence"]
+
+    merged = pd.merge(stops.assign(schedule_key=_schedule_key(
+                          stops["trip_id"], stops["stop_sequence"], categories)),
+                      scheduled,
+                      on="schedule_key",
+                      how=("outer" if outer else "left"),
+                      indicator=outer)
+    del merged["schedule_key"]
     if outer:
-        stop_times = stop_times.trip_id.isin(stops.trip_id)
-    return pd.merge(stops, stop_times[["trip_id", "stop_sequence", "arrival_time"]], 
-                    on=["trip_id", "stop_sequence"],
-                    how=("outer" if outer else "left"))
+        # Observations can have a missing trip_id too, so go by the merge
+        unobserved = (merged.pop("_merge") == "right_only").values
+        merged["trip_id"] = merged["trip_id"].astype(object)\
+            .where(~unobserved, merged.pop("scheduled_trip_id"))
+        merged["stop_sequence"] = merged["stop_sequence"]\
+            .where(~unobserved, merged.pop("scheduled_stop_sequence"))
+    merged["arrival_time"] = merged["arrival_time"].astype(object)
+    return merged
 
 
 def get_date(trip_start):
@@ -154,6 +725,38 @@ def convert_clock_time(arrival_time, start):
     )
 
 
+def parse_clock_times(clock_times):
+    """Convert a Series of GTFS clock time strings (HH:MM:SS, where the hour
+    may be 24 or more) to seconds after the start of the service day. Missing
+    values become NaN."""
+    clock_times = clock_times.str.strip()
+    return (pd.to_numeric(clock_times.str[:-6]) * 3600 +
+            pd.to_numeric(clock_times.str[-5:-3]) * 60 +
+            pd.to_numeric(clock_times.str[-2:]))
+
+
+def clock_times_to_timestamps(seconds, start):
+    """Convert seconds after the start of the service day to timestamps.
+
+    `start` is the service day anchor returned by `get_date` (noon minus
+    twelve hours). Clock times are offsets from that instant, so on days
+    with a DST transition the arithmetic is done in UTC and then converted,
+    which gives the same result as `convert_clock_time`.
+    """
+    anchor = pd.Timestamp(start).tz_convert("UTC")
+    # Converting missing seconds (of unscheduled trips) directly warns about
+    # casting NaN to int
+    missing = seconds.isna()
+    deltas = pd.to_timedelta(seconds.fillna(0), unit="s").where(~missing)
+    return (anchor + deltas).dt.tz_convert(TZ)
+
+
+def _arrival_seconds(df):
+    if "arrival_seconds" in df:
+        return df["arrival_seconds"]
+    return parse_clock_times(df["arrival_time"])
+
+
 def summarize_trip(trip_df, trip_start):
     name = trip_df.name
     total_stops = trip_df.arrival_time.nunique()
@@ -166,7 +769,7 @@ def summarize_trip(trip_df, trip_start):
     # For each stop, select the latest timestamp recorded.
     # (Note that this will also filter out missing timestamps.)
     # Then select the remaining rows in order of stop sequence
-    trip_df = trip_df.loc[trip_df.groupby("stop_sequence")["timestamp"].idxmax()]\
+    trip_df = trip_df.loc[trip_df.groupby("stop_sequence", observed=True)["timestamp"].idxmax()]\
                      .filter(seq_idx, axis=0)
     recorded_stops = trip_df["stop_sequence"].nunique()
     data = {
@@ -219,64 +822,573 @@ def summarize_trip(trip_df, trip_start):
     return pd.Series(data)
 
 
-def summarize_trips(stops, trip_start):
-    return stops.groupby("trip_id").apply(summarize_trip, trip_start=trip_start)
+SUMMARY_COLUMNS = ["min_marginal_delay_stop_id", "min_marginal_delay",
+                   "max_marginal_delay_stop_id", "max_marginal_delay",
+                   "recorded_stops", "scheduled_stops",
+                   "scheduled_start", "first_time", "first_delay",
+                   "first_stop_id", "first_scheduled_stop_id",
+                   "scheduled_end", "last_time", "last_delay",
+                   "last_stop_id", "last_scheduled_stop_id",
+                   "delay_50"]
+
+
+def _first_per_trip(df, column, ascending=True):
+    """Returns the first row of each trip in `df` (which must already be in
+    stop sequence order) for which `column` takes its minimum (or maximum)
+    non-null value within that trip."""
+    valid = df[df[column].notna()]
+    extreme = valid.groupby("trip_id", observed=True)[column]\
+                   .transform("min" if ascending else "max")
+    return valid[valid[column] == extreme].drop_duplicates("trip_id")\
+                                          .set_index("trip_id")
+
+
+def summarize_trips_vectorized(stops, trip_start):
+    """Computes the same summary as applying `summarize_trip` to each trip in
+    `stops`, but for the whole day at once."""
+    # Like groupby, skip observations with no trip (of non-revenue vehicles)
+    stops = stops[stops["trip_id"].notna()]
+    seq = pd.to_numeric(stops["stop_sequence"])
+    by_seq = stops.assign(seq=seq)\
+                  .sort_values("seq", kind="mergesort")\
+                  .sort_values("trip_id", kind="mergesort")
+    trip_ids = pd.Index(by_seq["trip_id"].unique(), name="trip_id").sort_values()
+
+    # The first and last scheduled stops consider every row, even those
+    # without a timestamp.
+    first_scheduled = by_seq.drop_duplicates("trip_id").set_index("trip_id")
+    last_scheduled = by_seq.drop_duplicates("trip_id", keep="last")\
+                           .set_index("trip_id")
+
+    # For each stop, select the latest timestamp recorded, then order the
+    # remaining rows by stop sequence.
+    recorded = stops[stops["stop_sequence"].notna() &
+                     stops["timestamp"].notna()]
+    recorded = recorded.sort_values("timestamp", ascending=False,
+                                    kind="mergesort")\
+                       .drop_duplicates(["trip_id", "stop_sequence"])\
+                       .sort_index()
+    recorded = recorded.assign(seq=seq[recorded.index])\
+                       .sort_values("seq", kind="mergesort")\
+                       .sort_values("trip_id", kind="mergesort")
+    scheduled = clock_times_to_timestamps(_arrival_seconds(recorded), trip_start)
+    recorded["delay"] = (recorded["timestamp"] - scheduled).dt.total_seconds()
+    recorded["marginal_delay"] = recorded.groupby("trip_id", observed=True)["delay"].diff()
+
+    first_recorded = recorded.drop_duplicates("trip_id").set_index("trip_id")
+    last_recorded = recorded.drop_duplicates("trip_id", keep="last")\
+                            .set_index("trip_id")
+    min_marginal = _first_per_trip(recorded, "marginal_delay")
+    max_marginal = _first_per_trip(recorded, "marginal_delay", ascending=False)
+    # Trips with no marginal delay (including those that are not in the
+    # static feed) have no delay information at all.
+    has_delay = trip_ids.isin(min_marginal.index)
+
+    def delay_info(values):
+        return values.reindex(trip_ids).where(has_delay)
+
+    summary = pd.DataFrame({
+        "trip_id": trip_ids,
+        "min_marginal_delay_stop_id": min_marginal["stop_id"].reindex(trip_ids),
+        "min_marginal_delay": min_marginal["marginal_delay"].reindex(trip_ids),
+        "max_marginal_delay_stop_id": max_marginal["stop_id"].reindex(trip_ids),
+        "max_marginal_delay": max_marginal["marginal_delay"].reindex(trip_ids),
+        "recorded_stops": recorded.groupby("trip_id", observed=True)["stop_sequence"]\
+                                  .nunique().reindex(trip_ids),
+        "scheduled_stops": stops.groupby("trip_id", observed=True)["arrival_time"]\
+                                .nunique().reindex(trip_ids),
+
+        "scheduled_start": clock_times_to_timestamps(
+            _arrival_seconds(first_scheduled), trip_start).reindex(trip_ids),
+        "first_time": first_recorded["timestamp"].reindex(trip_ids),
+        "first_delay": delay_info(first_recorded["delay"]),
+        "first_stop_id": first_recorded["stop_id"].reindex(trip_ids),
+        "first_scheduled_stop_id": delay_info(first_scheduled["stop_id"]),
+
+        "scheduled_end": clock_times_to_timestamps(
+            _arrival_seconds(last_scheduled), trip_start).reindex(trip_ids),
+        "last_time": last_recorded["timestamp"].reindex(trip_ids),
+        "last_delay": delay_info(last_recorded["delay"]),
+        "last_stop_id": last_recorded["stop_id"].reindex(trip_ids),
+        "last_scheduled_stop_id": delay_info(last_scheduled["stop_id"]),
+
+        "delay_50": delay_info(recorded.groupby("trip_id", observed=True)["delay"].median()),
+    }, index=trip_ids, columns=["trip_id"] + SUMMARY_COLUMNS)
+    return summary
+
+
+def summarize_trips(stops, trip_start, legacy=False):
+    """Summarize each trip in `stops`. When `legacy` is True, use the
+    original (much slower) per-trip implementation in `summarize_trip`."""
+    if legacy:
+        summary = stops.groupby("trip_id", observed=True)\
+                       .apply(summarize_trip, trip_start=trip_start)
+    else:
+        summary = summarize_trips_vectorized(stops, trip_start)
+    # A categorical trip_id is ordered by its categories, which need not be
+    # sorted.
+    summary.index = summary.index.astype(object)
+    return summary.sort_index()
+
+
+def rss_bytes():
+    """Returns the resident set size of this process, or None if it is not
+    available (it is read from /proc)."""
+    try:
+        with open("/proc/self/statm") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == "Darwin" else rss * 1024
+
+
+class StageMetrics:
+    """Records the wall time, output rows and change in RSS of each stage of
+    summarizing the file `filepath`. A stage that runs more than once (as
+    in process_file_streaming) is added up. Each stage is logged as a JSON
+    line when it ends, so the last line of a run that was killed shows how
+    far it got."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.started = time.time()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as the stage `name`. Set "rows" in the yielded
+        dict to record the number of rows the stage produced."""
+        info = {}
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        failed = True
+        try:
+            yield info
+            failed = False
+        finally:
+            seconds = time.perf_counter() - started
+            rss = rss_bytes()
+            # The metrics of this run of the stage
+            run = {"file": self.filepath, "stage": name,
+                   "seconds": round(seconds, 4), "rows": info.get("rows"),
+                   "max_rss_mb": max_rss_bytes() / 2**20}
+            if rss is not None and rss_before is not None:
+                run["rss_mb"] = rss / 2**20
+                run["rss_delta_mb"] = (rss - rss_before) / 2**20
+            if failed:
+                run["failed"] = True
+            logger.info("stage %s", json.dumps(run))
+
+            stage = self.stages.setdefault(
+                name, {"seconds": 0.0, "calls": 0, "rows": None,
+                       "rss_delta_mb": 0.0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+            if "rows" in info:
+                stage["rows"] = (stage["rows"] or 0) + info["rows"]
+            stage["rss_delta_mb"] += run.get("rss_delta_mb", 0.0)
+            for key in ["rss_mb", "max_rss_mb", "failed"]:
+                if key in run:
+                    stage[key] = run[key]
+
+    def as_dict(self):
+        return {"file": self.filepath,
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "seconds": time.time() - self.started,
+                "max_rss_mb": max_rss_bytes() / 2**20,
+                "stages": self.stages}
+
+    def log(self):
+        logger.info("metrics %s", json.dumps(self.as_dict()))
+
+    def write(self, path):
+        with open(path + ".part", "w") as outfile:
+            json.dump(self.as_dict(), outfile, indent=2)
+        os.replace(path + ".part", path)
+
+
+@contextmanager
+def profiled(path):
+    """Profiles the block with cProfile, writing the stats to `path` (for
+    pstats or snakeviz). Does nothing if `path` is None."""
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profile.dump_stats(path)
+
+
+def profile_path(filepath, profile_dir=None):
+    """Returns where to write the profile of processing `filepath`, or None
+    if profiling is off (`profile_dir` and PROFILE_DIR are unset)."""
+    profile_dir = profile_dir or PROFILE_DIR
+    if not profile_dir:
+        return None
+    return os.path.join(profile_dir, os.path.basename(filepath) + ".prof")
 
 
-def process_file(filepath, get_feed=mbta_feed_for):
+def process_file(filepath, get_feed=mbta_feed_for, legacy=False,
+                 partitions=None, metrics=None):
+    """Summarize the trips in the daily file `filepath`. If `partitions` is
+    given, the file is summarized with `process_file_streaming`. The time
+    spent in each stage is recorded in `metrics` (a StageMetrics), if
+    given."""
+    metrics = metrics or StageMetrics(filepath)
     dt = date_from_filepath(filepath)
     trip_start = TZ.localize(datetime(dt.year, dt.month, dt.day).replace(hour=12)) - timedelta(hours=12)
 
-    feed = get_feed(dt)
-    return add_route_info(
-        summarize_trips(
-            add_schedule_times(get_df(filepath), feed),
-            trip_start),
-        feed)
+    with metrics.stage("get_feed"):
+        feed = get_feed(dt)
+    with metrics.stage("feed_tables") as info:
+        info["rows"] = sum(len(get_feed_table(feed, name))
+                           for name in FEED_TABLES)
+        get_trip_offsets(feed)
+    if partitions:
+        summary = process_file_streaming(filepath, feed, trip_start,
+                                         partitions, legacy=legacy,
+                                         metrics=metrics)
+    else:
+        with metrics.stage("get_df") as info:
+            df = get_df(filepath)
+            info["rows"] = len(df)
+        with metrics.stage("add_schedule_times") as info:
+            stops = add_schedule_times(df, feed)
+            info["rows"] = len(stops)
+        del df
+        with metrics.stage("summarize_trips") as info:
+            summary = summarize_trips(stops, trip_start, legacy=legacy)
+            info["rows"] = len(summary)
+        del stops
+    with metrics.stage("add_route_info") as info:
+        summary = add_route_info(summary, feed)
+        info["rows"] = len(summary)
+    return summary
 
 
-def getpaths(indir, outdir):
+def process_file_streaming(filepath, feed, trip_start, partitions,
+                           spill_dir=None, legacy=False, metrics=None):
+    """Summarize the trips in `filepath` without loading the whole day at
+    once. The file is split by trip into at least `partitions` files in a
+    temporary directory under `spill_dir`, more if needed to keep each to
+    about PARTITION_ROWS rows (see estimate_rows), and each is summarized in
+    turn. Observation files are also read a block at a time, so peak memory
+    depends on the size of a partition rather than of the day. The result is
+    the same as that of `summarize_trips` on the whole file.
+    """
+    metrics = metrics or StageMetrics(filepath)
+    estimate = estimate_rows(filepath)
+    if estimate:
+        partitions = max(partitions, math.ceil(estimate / PARTITION_ROWS))
+    logger.info("Summarizing %s in %d partitions", filepath, partitions)
+    summaries = []
+    with tempfile.TemporaryDirectory(prefix="partitions", dir=spill_dir) as tmpdir:
+        with metrics.stage("partition_file"):
+            paths = partition_file(filepath, tmpdir, partitions)
+        for path in paths:
+            with metrics.stage("get_df") as info:
+                df = read_observations(path)
+                info["rows"] = len(df)
+            with metrics.stage("add_schedule_times") as info:
+                stops = add_schedule_times(df, feed)
+                info["rows"] = len(stops)
+            del df
+            with metrics.stage("summarize_trips") as info:
+                summaries.append(summarize_trips(stops, trip_start,
+                                                 legacy=legacy))
+                info["rows"] = len(summaries[-1])
+            del stops
+    return pd.concat(summaries).sort_index()
+
+
+# Columns of the summaries output by process_file, by type
+SUMMARY_TIMESTAMP_COLUMNS = ["scheduled_start", "first_time",
+                             "scheduled_end", "last_time"]
+SUMMARY_FLOAT_COLUMNS = ["min_marginal_delay", "max_marginal_delay",
+                         "first_delay", "last_delay", "delay_50"]
+SUMMARY_INT_COLUMNS = ["recorded_stops", "scheduled_stops"]
+SUMMARY_CATEGORY_COLUMNS = ["min_marginal_delay_stop_id",
+                            "max_marginal_delay_stop_id", "first_stop_id",
+                            "first_scheduled_stop_id", "last_stop_id",
+                            "last_scheduled_stop_id", "route_id",
+                            "direction_id"]
+
+
+def typed_summary(summary):
+    """Returns a copy of the output of process_file with a fixed schema:
+    timestamps in US/Eastern, float delays, integer stop counts and
+    categorical ids."""
+    typed = summary.reset_index(drop=True)
+    for column in SUMMARY_TIMESTAMP_COLUMNS:
+        typed[column] = pd.to_datetime(typed[column], utc=True).dt.tz_convert(TZ)
+    for column in SUMMARY_FLOAT_COLUMNS:
+        typed[column] = pd.to_numeric(typed[column]).astype(np.float64)
+    for column in SUMMARY_INT_COLUMNS:
+        typed[column] = pd.to_numeric(typed[column])
+    for column in SUMMARY_CATEGORY_COLUMNS:
+        typed[column] = typed[column].astype(object).astype("category")
+    typed["trip_id"] = typed["trip_id"].astype(object)
+    return typed
+
+
+# Maps each summary output format to its file extension
+SUMMARY_FORMATS = {"csv": ".csv", "parquet": ".parquet"}
+
+
+def write_summary(summary, outpath):
+    """Write the output of process_file to `outpath`, as Parquet if it ends
+    with .parquet (which requires pyarrow or fastparquet) and otherwise as
+    CSV."""
+    if outpath.endswith(".parquet"):
+        typed_summary(summary).to_parquet(outpath)
+    else:
+        summary.to_csv(outpath)
+
+
+# Width, in seconds, of the histogram bins used to estimate median delays
+# from route aggregates. Medians estimated from the histograms are within
+# one bin width of the lower median (the middle delay, or the lower of the
+# two middle delays), provided it lies in DELAY_BIN_RANGE.
+DELAY_BIN_SECONDS = 30
+# Delays outside this range are counted in the lowest or highest bin
+DELAY_BIN_RANGE = (-3600, 7200)
+
+
+def delay_bins(delays):
+    """Returns the histogram bin of each delay. Bin i counts delays from
+    i * DELAY_BIN_SECONDS up to (i + 1) * DELAY_BIN_SECONDS."""
+    low, high = DELAY_BIN_RANGE
+    return np.floor(delays / DELAY_BIN_SECONDS)\
+             .clip(low // DELAY_BIN_SECONDS - 1, high // DELAY_BIN_SECONDS)
+
+
+def route_aggregates(summary):
+    """Computes mergeable statistics for the trips in `summary` (the output of
+    process_file) that have delay information, per route and per hour of
+    the scheduled start (-1 when it is unknown).
+
+    The result is in long format, with the columns route_id, hour, stat, bin
+    and value. Statistics from any number of days can be combined by summing
+    `value` over the other columns (see route_summaries.merge_aggregates).
+    Counts and sums have bin 0. The first_delay_hist and last_delay_hist
+    statistics count delays in each histogram bin (see `delay_bins`).
+    """
+    df = summary[summary["first_delay"].notna()]
+    hours = pd.to_datetime(df["scheduled_start"], utc=True).dt.tz_convert(TZ)\
+              .dt.hour.fillna(-1).astype(int)
+    df = df.assign(route_id=df["route_id"].astype(object), hour=hours.values)
+    groups = df.groupby(["route_id", "hour"])
+
+    stats = {"count": groups["trip_id"].count(),
+             "total_stops_recorded": groups["recorded_stops"].sum()}
+    for column in ["first_delay", "last_delay", "delay_50"]:
+        stats[column + "_count"] = groups[column].count()
+        stats[column + "_sum"] = groups[column].sum()
+    frames = [series.rename("value").reset_index().assign(stat=stat, bin=0)
+              for stat, series in stats.items()]
+    for column in ["first_delay", "last_delay"]:
+        hist = df.assign(bin=delay_bins(df[column]))\
+                 .groupby(["route_id", "hour", "bin"]).size()
+        frames.append(hist.rename("value").reset_index()
+                          .assign(stat=column + "_hist"))
+
+    aggregates = pd.concat(frames, ignore_index=True)
+    aggregates["bin"] = aggregates["bin"].astype(int)
+    return aggregates[["route_id", "hour", "stat", "bin", "value"]]
+
+
+def aggregates_path(outpath):
+    """Returns the path of the route aggregates that go with the summary at
+    `outpath`."""
+    base = re.sub(r"(\.csv|\.parquet)(\.gz)?$", "", outpath)
+    return base + ".routes.csv"
+
+
+def getpaths(indir, outdir, ext=".csv"):
     for d, subdirs, files in os.walk(indir, topdown=True):
         if os.path.samefile(d, indir):
             for i in range(len(subdirs)-1, -1, -1):
                 if not re.match(r"\d{4}", subdirs[i]):
                     del subdirs[i]
             continue
+        # Prefer an observation file to the CSV file it was converted from
         for filename in files:
-            m = re.match(r"(\d{4}-\d{2}-\d{2})\.csv\.gz$", filename)
-            if m:
+            m = re.match(r"(\d{4}-\d{2}-\d{2})\.(csv\.gz|obs|obs\.gz)$",
+                         filename)
+            if m and (m.group(2) != "csv.gz" or not
+                      {m.group(1) + ".obs", m.group(1) + ".obs.gz"} & set(files)):
                 yield (os.path.join(d, filename),
-                       os.path.join(outdir, "{ymd}.csv".format(ymd=m.group(1))))
+                       os.path.join(outdir, m.group(1) + ext))
+
+
+def summary_metadata(filepath, location):
+    """Returns a dict describing the inputs used to produce the summary of
+    `filepath`. If it matches the metadata stored alongside an existing
+    summary, that summary is up to date."""
+    st = os.stat(filepath)
+    url, basename = location
+    return {"input_size": st.st_size,
+            "input_mtime": st.st_mtime,
+            "feed": basename or os.path.basename(url),
+            "version": SUMMARY_VERSION}
+
+
+def metadata_path(outpath):
+    return outpath + ".meta.json"
 
 
-def init(dl_lock):
-    global lock
-    lock = dl_lock
+def metrics_path(outpath):
+    return outpath + ".metrics.json"
 
 
-def get_feed_locking(when):
-    lock.acquire()
+def is_up_to_date(filepath, outpath, location):
     try:
-        return mbta_feed_for(when)
-    finally:
-        lock.release()
+        with open(metadata_path(outpath)) as infile:
+            metadata = json.load(infile)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(outpath) and \
+        os.path.exists(aggregates_path(outpath)) and \
+        metadata == summary_metadata(filepath, location)
+
+
+def write_metadata(filepath, outpath, location):
+    path = metadata_path(outpath)
+    with open(path + ".part", "w") as outfile:
+        json.dump(summary_metadata(filepath, location), outfile)
+    os.replace(path + ".part", path)
 
 
-def do_process(args):
-    (filepath, outpath) = args
+def do_process(args, partitions=None, write_metrics=False, profile_dir=None):
+    """Processes one (filepath, outpath, location) tuple, where location is
+    the feed location returned by mbta_feed_location. Returns True if it
+    succeeded. The stage metrics are logged, and written next to the output
+    if `write_metrics` is True. If `profile_dir` (or PROFILE_DIR) is set,
+    a profile of the run is written there."""
+    (filepath, outpath, location) = args
     print(f"Processing {filepath}")
+    metrics = StageMetrics(filepath)
     try:
-        process_file(filepath, get_feed_locking).to_csv(outpath)
+        with profiled(profile_path(filepath, profile_dir)):
+            summary = process_file(filepath, partitions=partitions,
+                                   metrics=metrics)
+            with metrics.stage("write_summary") as info:
+                write_summary(summary, outpath)
+                info["rows"] = len(summary)
+            with metrics.stage("route_aggregates") as info:
+                aggregates = route_aggregates(summary)
+                aggregates.to_csv(aggregates_path(outpath), index=False)
+                info["rows"] = len(aggregates)
+        write_metadata(filepath, outpath, location)
         print(f"Wrote to {outpath}")
+        return True
     except Exception as exc:
         logger.exception("Processing failed for %s", filepath)
+        return False
+    finally:
+        metrics.log()
+        if write_metrics:
+            metrics.write(metrics_path(outpath))
+
+
+def do_process_group(group, **kwargs):
+    return [do_process(args, **kwargs) for args in group]
+
+
+def schedule_by_feed(paths, max_group_size):
+    """Groups the (filepath, outpath, location) tuples in `paths` by feed
+    location, then splits the groups into lists of at most `max_group_size`
+    tuples. Each list is processed by one worker, which keeps its feed's
+    tables in memory across the whole list.
+    """
+    groups = defaultdict(list)
+    for path in paths:
+        groups[path[2]].append(path)
+
+    tasks = []
+    for group in groups.values():
+        group.sort()
+        tasks.extend(group[i:i+max_group_size]
+                     for i in range(0, len(group), max_group_size))
+    # Start the longest tasks first
+    tasks.sort(key=len, reverse=True)
+    return tasks
+
+
+def process_all(indir=".", outdir="./summary", processes=None, force=False,
+                since=None, partitions=None, fmt="csv",
+                write_metrics=WRITE_METRICS, profile_dir=None):
+    """Summarize every daily file in `indir` dated on or after `since` (a
+    datetime), writing the results to `outdir` in the format `fmt` (a key
+    of SUMMARY_FORMATS). Unless `force` is True, files whose summaries are
+    already up to date are skipped. If `partitions` is given, each file is
+    summarized in that many pieces to limit memory use. See `do_process`
+    for `write_metrics` and `profile_dir`.
+    """
+    paths = [(filepath, outpath) for filepath, outpath
+             in getpaths(indir, outdir, SUMMARY_FORMATS[fmt])
+             if not since or date_from_filepath(filepath) >= since]
+    locations = mbta_feed_locations([date_from_filepath(filepath)
+                                     for filepath, _ in paths])
+    paths = [(filepath, outpath, location)
+             for (filepath, outpath), location in zip(paths, locations)]
+    todo = [path for path in paths if force or not is_up_to_date(*path)]
+    skipped = len(paths) - len(todo)
+
+    processes = processes or os.cpu_count()
+    # Keep groups small enough that a single feed's days are still spread
+    # across all the workers.
+    max_group_size = max(1, math.ceil(len(todo) / processes))
+    os.makedirs(outdir, exist_ok=True)
+    with mp.Pool(processes) as pool:
+        results = pool.map(partial(do_process_group, partitions=partitions,
+                                   write_metrics=write_metrics,
+                                   profile_dir=profile_dir),
+                           schedule_by_feed(todo, max_group_size),
+                           chunksize=1)
+    succeeded = sum(sum(group) for group in results)
+    print(f"Processed {succeeded} files, {len(todo) - succeeded} failed, "
+          f"{skipped} up to date")
+
 
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize the daily trip files found in a directory")
+    parser.add_argument("indir", nargs="?", default=".")
+    parser.add_argument("outdir", nargs="?", default="./summary")
+    parser.add_argument("--force", action="store_true",
+                        help="process files even if their summaries are up to date")
+    parser.add_argument("--since", type=lambda d: datetime.strptime(d, "%Y-%m-%d"),
+                        help="only process files dated on or after this YYYY-mm-dd date")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--partitions", type=int,
+                        help="summarize each file in at least this many pieces "
+                        "(more for large files) to save memory")
+    parser.add_argument("--format", choices=sorted(SUMMARY_FORMATS),
+                        default="csv", help="output format for the summaries")
+    parser.add_argument("--metrics", action="store_true", default=WRITE_METRICS,
+                        help="write the time, rows and memory use of each "
+                        "stage next to each summary, as .metrics.json")
+    parser.add_argument("--profile", metavar="DIR", default=PROFILE_DIR,
+                        help="write a cProfile profile of each file to DIR")
+    args = parser.parse_args(args)
 
-def process_all(indir=".", outdir="./summary"):
-    dl_lock = Lock()
-    with mp.Pool(initializer=init, initargs=(dl_lock,)) as pool:
-        pool.map(do_process, getpaths(indir, outdir))
+    logging.basicConfig(level=logging.INFO)
+    process_all(args.indir, args.outdir, processes=args.processes,
+                force=args.force, since=args.since,
+                partitions=args.partitions, fmt=args.format,
+                write_metrics=args.metrics, profile_dir=args.profile)
 
 
 if __name__ == "__main__":
-    process_all()
+    main()
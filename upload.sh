@@ -9,7 +9,7 @@ for csv_file in *.csv; do
         echo "Processing $csv_file"
         year="${BASH_REMATCH[1]}"
         month="${BASH_REMATCH[2]}"
-        uniq < $csv_file | gzip > $csv_file.gz
+        gzip < $csv_file > $csv_file.gz
         aws s3 cp $csv_file.gz \
             s3://mbta-history.apptic.xyz/$year/$month/$csv_file.gz \
             --acl public-read || exit 1